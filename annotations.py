@@ -0,0 +1,161 @@
+import numpy as np
+
+
+# one row per box: [class, x1, y1, x2, y2(, confidence)] of a slice
+BOX_DTYPE = np.dtype([
+    ("slice", np.int32),
+    ("class", np.int32),
+    ("x1", np.float64),
+    ("y1", np.float64),
+    ("x2", np.float64),
+    ("y2", np.float64),
+    ("conf", np.float64),
+    ("flags", np.uint8),
+])
+VALUE_FIELDS = ("class", "x1", "y1", "x2", "y2", "conf")
+# flags: bit i is set when value i was a JSON integer, HAS_CONF when the box has a confidence
+HAS_CONF = 1 << len(VALUE_FIELDS)
+
+
+def encode_box(slice_idx, bbox):
+    '''
+    Function returns a BOX_DTYPE record of a JSON box [class, x1, y1, x2, y2(, confidence)]
+    '''
+    if len(bbox) not in (5, 6):
+        raise ValueError(f"a box must be [class, x1, y1, x2, y2(, confidence)], got {bbox}")
+    if float(bbox[0]) != int(bbox[0]):
+        raise ValueError(f"box class must be integral, got {bbox[0]}")
+    flags = HAS_CONF if len(bbox) == 6 else 0
+    for i, value in enumerate(bbox):
+        if isinstance(value, (int, np.integer)):
+            flags |= 1 << i
+    return (slice_idx, int(bbox[0]), *bbox[1:5], bbox[5] if len(bbox) == 6 else 0., flags)
+
+
+def decode_boxes(records):
+    '''
+    Function returns JSON boxes (lists with integers where the source had integers) of BOX_DTYPE records,
+    values are converted column by column into an object array, so lists are built by NumPy
+    '''
+    flags = records["flags"]
+    n_values = len(VALUE_FIELDS) - 1
+    values = np.empty((len(records), n_values), dtype=object)
+    for i, field in enumerate(VALUE_FIELDS[:n_values]):
+        is_int = (flags & (1 << i)) != 0
+        if is_int.all():
+            values[:, i] = records[field].astype(np.int64).astype(object)
+        elif not is_int.any():
+            values[:, i] = records[field].astype(np.float64).astype(object)
+        else:
+            values[:, i] = np.where(is_int, records[field].astype(np.int64).astype(object), records[field].astype(np.float64).astype(object))
+    bboxes = values.tolist()
+    has_conf = np.flatnonzero(flags & HAS_CONF)
+    if len(has_conf):
+        is_int = (flags[has_conf] & (1 << n_values)) != 0
+        conf = np.where(is_int, records["conf"][has_conf].astype(np.int64).astype(object), records["conf"][has_conf].astype(object)).tolist()
+        for i, value in zip(has_conf.tolist(), conf):
+            bboxes[i].append(value)
+    return bboxes
+
+
+class AnnotationStore:
+    """
+    Boxes of one series in a NumPy structured array (BOX_DTYPE).
+
+    `slices` indexes the rows of every slice (slice_idx -> {row id: None}, in box order), so lookups
+    by slice, counts, additions and removals by row id are O(1). Removed rows are only unlinked from
+    the index. Everything else the JSON checkpoint keeps for a slice (its key, "filename", key order)
+    is kept in `slice_info`, so `to_json(from_json(labels)) == labels`.
+    """
+    def __init__(self, capacity=64):
+        self.rows = np.zeros(capacity, dtype=BOX_DTYPE)
+        self.n_rows = 0
+        self.slices = {}
+        self.slice_info = {}  # slice_idx -> (slice key, {key: value} of the slice entry with "bboxes" as a placeholder)
+        self.n_boxes = 0
+
+    def __bool__(self):
+        return bool(self.slices)
+
+    @property
+    def n_slices(self):
+        return len(self.slices)
+
+    @classmethod
+    def from_json(cls, series_labels):
+        '''
+        Builds the store from the labels of one series: {slice key: {"bboxes": [[class, x1, y1, x2, y2], ...], ...}}
+        '''
+        store = cls(capacity=max(64, sum(len(entry.get("bboxes", [])) for entry in series_labels.values())))
+        for slice_key, entry in series_labels.items():
+            slice_idx = int(slice_key)
+            store.slices[slice_idx] = {}
+            store.slice_info[slice_idx] = (slice_key, {key: (None if key == "bboxes" else value) for key, value in entry.items()})
+            for bbox in entry.get("bboxes", []):
+                store._append(slice_idx, bbox)
+        return store
+
+    def to_json(self):
+        series_labels = {}
+        for slice_idx, rows in self.slices.items():
+            slice_key, info = self.slice_info[slice_idx]
+            bboxes = [self.bbox(row) for row in rows]
+            series_labels[slice_key] = {key: (bboxes if key == "bboxes" else value) for key, value in info.items()}
+        return series_labels
+
+    def _append(self, slice_idx, bbox):
+        record = encode_box(slice_idx, bbox)
+        if self.n_rows == len(self.rows):
+            self.rows = np.concatenate([self.rows, np.zeros(len(self.rows), dtype=BOX_DTYPE)])
+
+        row = self.n_rows
+        self.rows[row] = record
+        self.n_rows += 1
+        self.slices[slice_idx][row] = None
+        self.n_boxes += 1
+        return row
+
+    def add(self, slice_idx, bbox, **info):
+        '''
+        Adds bbox to the slice, info (e.g. filename) is set on the slice entry, returns the row id of the box
+        '''
+        if slice_idx not in self.slices:
+            self.slices[slice_idx] = {}
+            self.slice_info[slice_idx] = (str(slice_idx), {"bboxes": None})
+        self.slice_info[slice_idx][1].update(info)
+        return self._append(slice_idx, bbox)
+
+    def remove(self, row):
+        '''
+        Removes the box of a row id, a slice without boxes is removed too
+        '''
+        slice_idx = int(self.rows["slice"][row])
+        del self.slices[slice_idx][row]
+        self.n_boxes -= 1
+        if not self.slices[slice_idx]:
+            del self.slices[slice_idx]
+            del self.slice_info[slice_idx]
+
+    def bbox(self, row):
+        '''
+        Returns the box of a row as it is stored in JSON (integers stay integers)
+        '''
+        record = self.rows[row]
+        flags = int(record["flags"])
+        n_values = len(VALUE_FIELDS) if flags & HAS_CONF else len(VALUE_FIELDS) - 1
+        return [int(record[field]) if flags & (1 << i) else float(record[field]) for i, field in enumerate(VALUE_FIELDS[:n_values])]
+
+    def boxes(self, slice_idx):
+        '''
+        Returns [(row id, bbox), ...] of a slice
+        '''
+        return [(row, self.bbox(row)) for row in self.slices.get(slice_idx, ())]
+
+    def find(self, slice_idx, bbox):
+        '''
+        Returns the row id of the first box of the slice equal to bbox or None
+        '''
+        for row in self.slices.get(slice_idx, ()):
+            if self.bbox(row) == list(bbox):
+                return row
+        return None
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+from checkpoint import save_npz, is_sharded, shard_name, sharded_manifest, stash_path, ShardedLabels, MANIFEST, SHARDS_DIR
+
+
+def _indented(value, level):
+    # json.dumps(value, indent=4) of a value nested `level` levels deep in an indent=4 document
+    return json.dumps(value, ensure_ascii=False, indent=4).replace("\n", "\n" + " " * (4 * level))
+
+
+def _snapshot_labels(labels):
+    # a copy of the labels mapping the saving thread can read while the viewer adds and removes series
+    if isinstance(labels, ShardedLabels):
+        snapshot = ShardedLabels(labels.directory, dict(labels.shards))
+        snapshot.loaded = dict(labels.loaded)
+        return snapshot
+    return dict(labels)
+
+
+class Autosaver:
+    """
+    Writes the checkpoint on a background thread.
+
+    Changed series are marked dirty. `save` takes a snapshot of the dirty series on the Tk thread
+    (references to their labels, which the viewer replaces instead of modifying), the thread serializes
+    only those series and joins them with the JSON text cached for the other series. The output is
+    identical to json.dump(ct_series_data, indent=4). A .npz destination is written whole by save_npz
+    from a shallow copy of the labels. A sharded destination gets new shards of the changed series only
+    and a new manifest. The checkpoint (or manifest) is written to a temp file and renamed over
+    the destination, then the journal operations it contains are truncated.
+
+    Labels removed by clearing the checkpoint are kept as a stash (`add_stash`) for as long as the clearing
+    can be undone: the first save containing the clearing writes them next to the checkpoint, the journal
+    references the stash instead of holding the labels, and the first save after `release_stash` deletes it.
+    Shards referenced by a stash are never deleted as old shards.
+    """
+    def __init__(self, output_path, journal, interval=30.0, labels=None):
+        self.output_path = output_path
+        self.journal = journal
+        self.interval = interval
+        self.fragments = {}  # folder_key -> JSON text of the series labels
+        self.shards = {}  # folder_key -> shard file name in the manifest of a sharded destination
+        if is_sharded(output_path):
+            os.makedirs(output_path, exist_ok=True)
+            if isinstance(labels, ShardedLabels) and os.path.realpath(labels.directory) == os.path.realpath(output_path):
+                self.shards = {folder_key: name for folder_key, name in labels.shards.items() if name is not None}
+        self.dirty = set()
+        self.all_dirty = False
+        self.requested = False
+        self.last_save = time.monotonic()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stashes = {}  # stash id -> {"labels", "seq" (clearing), "released" (seq), "written", "shards"}
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_dirty(self):
+        return self.all_dirty or bool(self.dirty)
+
+    def mark_dirty(self, folder_key=None):
+        '''
+        Marks a series as changed, None marks every series
+        '''
+        with self.lock:
+            if folder_key is None:
+                self.all_dirty = True
+            else:
+                self.dirty.add(folder_key)
+
+    def add_stash(self, stash_id, labels, seq):
+        '''
+        Keeps labels removed by the journal operation seq until the stash is released
+        '''
+        with self.lock:
+            self.stashes[stash_id] = {"labels": labels, "seq": seq, "released": None, "written": False, "shards": set()}
+
+    def release_stash(self, stash_id, seq):
+        '''
+        Deletes the stash with the first save containing the journal operation seq (restoring or dropping it)
+        '''
+        with self.lock:
+            if stash_id in self.stashes:
+                self.stashes[stash_id]["released"] = seq
+
+    def release_leftover_stashes(self, seq):
+        '''
+        Releases the stashes left on disk by a previous session, replay has already read the ones it needs
+        '''
+        directory, name = os.path.split(stash_path(self.output_path, "*"))
+        prefix, suffix = name.split("*")
+        for file_name in os.listdir(directory or "."):
+            if not (file_name.startswith(prefix) and file_name.endswith(suffix)):
+                continue
+            shards = set()
+            if is_sharded(self.output_path):
+                with open(os.path.join(directory, file_name), mode="r", encoding="UTF-8") as file:
+                    shards = {name for name in json.load(file)["series"].values() if name is not None}
+            with self.lock:
+                self.stashes.setdefault(file_name[len(prefix):-len(suffix)],
+                                        {"labels": None, "seq": 0, "released": seq, "written": True, "shards": shards})
+
+    def due(self):
+        return self.requested or (self.interval > 0 and self.is_dirty() and time.monotonic() - self.last_save >= self.interval)
+
+    def save(self, ct_series_data):
+        '''
+        Starts writing the checkpoint in background, returns False if a save is already in progress
+        '''
+        if self.busy:
+            self.requested = True
+            return False
+        self.requested = False
+        self.last_save = time.monotonic()
+
+        saved_seq = self.journal.mark(ct_series_data)
+        labels = ct_series_data["labels"]
+        with self.lock:
+            dirty, all_dirty = self.dirty, self.all_dirty
+            self.dirty, self.all_dirty = set(), False
+            # stashes of clearings contained in this save, unless they are released by it as well
+            new_stashes = {stash_id: dict(stash, labels=_snapshot_labels(stash["labels"]))
+                           for stash_id, stash in self.stashes.items()
+                           if not stash["written"] and stash["seq"] <= saved_seq and (stash["released"] is None or stash["released"] > saved_seq)}
+            # stashes restored or dropped by this save -> their shards
+            released = {stash_id: self._stash_shards(stash) for stash_id, stash in self.stashes.items()
+                        if stash["released"] is not None and stash["released"] <= saved_seq}
+        if is_sharded(self.output_path):
+            self._save_shards(ct_series_data, dirty, all_dirty, saved_seq, new_stashes, released)
+            return True
+
+        folder_keys = list(labels)
+        changed = {folder_key: labels[folder_key] for folder_key in folder_keys
+                   if all_dirty or folder_key in dirty or folder_key not in self.fragments}
+        if self.output_path.endswith(".npz"):
+            snapshot = {key: (dict(labels) if key == "labels" else value) for key, value in ct_series_data.items()}
+            self.thread = threading.Thread(target=self._write_npz, args=(snapshot, changed, saved_seq, new_stashes, released),
+                                           daemon=True)
+            self.thread.start()
+            return True
+
+        header = [(key, value) for key, value in ct_series_data.items() if key != "labels"]
+        position = list(ct_series_data).index("labels")
+
+        self.thread = threading.Thread(target=self._write, args=(header, position, folder_keys, changed, saved_seq, new_stashes, released),
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def _write(self, header, position, folder_keys, changed, saved_seq, new_stashes, released):
+        try:
+            self._write_stashes(new_stashes)
+            for folder_key, series_labels in changed.items():
+                self.fragments[folder_key] = _indented(series_labels, 2)
+            for folder_key in set(self.fragments) - set(folder_keys):
+                del self.fragments[folder_key]
+
+            if folder_keys:
+                labels_text = "{\n" + ",\n".join(f"        {json.dumps(folder_key, ensure_ascii=False)}: {self.fragments[folder_key]}"
+                                                 for folder_key in folder_keys) + "\n    }"
+            else:
+                labels_text = "{}"
+            items = [f"    {json.dumps(key, ensure_ascii=False)}: {_indented(value, 1)}" for key, value in header]
+            items.insert(position, f'    "labels": {labels_text}')
+
+            with open(self.output_path + ".tmp", mode="w", encoding="UTF-8") as output_file:
+                output_file.write("{\n" + ",\n".join(items) + "\n}")
+                self._commit(output_file, self.output_path, saved_seq)
+            self._delete_stashes(released)
+        except Exception as e:
+            self._failed(e, changed)
+
+    def _write_npz(self, snapshot, changed, saved_seq, new_stashes, released):
+        try:
+            self._write_stashes(new_stashes)
+            with open(self.output_path + ".tmp", mode="wb") as output_file:
+                save_npz(snapshot, output_file)
+                self._commit(output_file, self.output_path, saved_seq)
+            self._delete_stashes(released)
+        except Exception as e:
+            self._failed(e, changed)
+
+    def _in_place(self, labels):
+        return isinstance(labels, ShardedLabels) and os.path.realpath(labels.directory) == os.path.realpath(self.output_path)
+
+    def _stash_shards(self, stash):
+        # shards referenced by a stash, before it is written these are the shards of its labels in the checkpoint directory
+        if stash["written"] or not self._in_place(stash["labels"]):
+            return set(stash["shards"])
+        return {name for name in stash["labels"].shards.values() if name is not None}
+
+    def _save_shards(self, ct_series_data, dirty, all_dirty, saved_seq, new_stashes, released):
+        labels = ct_series_data["labels"]
+        loaded = labels.loaded if isinstance(labels, ShardedLabels) else labels
+        in_place = self._in_place(labels)
+        generation = uuid.uuid4().hex[:8]
+        shards, changed = {}, {}
+        for folder_key in labels:
+            if not (all_dirty or folder_key in dirty or folder_key not in self.shards):
+                shards[folder_key] = self.shards[folder_key]
+            elif in_place and folder_key not in loaded:
+                shards[folder_key] = labels.shards[folder_key]  # never read, so its shard is up to date
+            else:
+                shards[folder_key] = shard_name(folder_key, generation)
+                # series that have not been read are read from their shard by the saving thread
+                changed[folder_key] = loaded[folder_key] if folder_key in loaded else labels.shard_path(folder_key)
+
+        for stash in new_stashes.values():
+            stash_labels = stash["labels"]
+            stash["shards"], stash["changed"] = {}, {}
+            for folder_key in stash_labels:
+                if self._in_place(stash_labels) and folder_key not in stash_labels.loaded:
+                    stash["shards"][folder_key] = stash_labels.shards[folder_key]
+                else:
+                    stash["shards"][folder_key] = shard_name(folder_key, generation + "s")
+                    stash["changed"][folder_key] = stash_labels.peek if isinstance(stash_labels, ShardedLabels) else stash_labels.get
+        # shards of the labels kept by a stash stay on disk until the stash is deleted
+        with self.lock:
+            kept = set()
+            for stash_id, stash in self.stashes.items():
+                if stash_id in new_stashes:
+                    kept |= set(new_stashes[stash_id]["shards"].values())
+                elif stash_id not in released:
+                    kept |= self._stash_shards(stash)
+        old_names = [name for folder_key, name in self.shards.items() if shards.get(folder_key) != name and name not in kept]
+        manifest = sharded_manifest(ct_series_data, shards)
+
+        self.thread = threading.Thread(target=self._write_shards, args=(manifest, changed, old_names, saved_seq, new_stashes, released, kept),
+                                       daemon=True)
+        self.thread.start()
+
+    def _write_shard(self, name, series_labels):
+        with open(os.path.join(self.output_path, SHARDS_DIR, name), mode="w", encoding="UTF-8") as file:
+            json.dump(series_labels, file, ensure_ascii=False, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _write_shards(self, manifest, changed, old_names, saved_seq, new_stashes, released, kept):
+        try:
+            os.makedirs(os.path.join(self.output_path, SHARDS_DIR), exist_ok=True)
+            self._write_stashes(new_stashes)
+            for folder_key, series_labels in changed.items():
+                if isinstance(series_labels, str):
+                    with open(series_labels, mode="r", encoding="UTF-8") as file:
+                        series_labels = json.load(file)
+                # a new file name for every write, the manifest still references the previous shard
+                self._write_shard(manifest["series"][folder_key], series_labels)
+
+            manifest_path = os.path.join(self.output_path, MANIFEST)
+            with open(manifest_path + ".tmp", mode="w", encoding="UTF-8") as output_file:
+                json.dump(manifest, output_file, ensure_ascii=False, indent=4)
+                self._commit(output_file, manifest_path, saved_seq)
+            self.shards = manifest["series"]
+            self._delete_stashes(released, kept | set(self.shards.values()))
+            for name in old_names:
+                try:
+                    os.remove(os.path.join(self.output_path, SHARDS_DIR, name))
+                except FileNotFoundError:
+                    pass
+        except Exception as e:
+            self._failed(e, changed)
+
+    def _write_stashes(self, new_stashes):
+        # runs on the saving thread before the checkpoint containing the clearings is written
+        for stash_id, stash in new_stashes.items():
+            path = stash_path(self.output_path, stash_id)
+            if is_sharded(self.output_path):
+                for folder_key, read in stash["changed"].items():
+                    self._write_shard(stash["shards"][folder_key], read(folder_key))
+                with open(path + ".tmp", mode="w", encoding="UTF-8") as file:
+                    json.dump(sharded_manifest({"labels": None}, stash["shards"]), file, ensure_ascii=False, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                shards = set(stash["shards"].values())
+            else:
+                stash_labels = stash["labels"]
+                read = stash_labels.peek if isinstance(stash_labels, ShardedLabels) else stash_labels.get
+                stash_data = {"labels": {folder_key: read(folder_key) for folder_key in stash_labels}}
+                if path.endswith(".npz"):
+                    with open(path + ".tmp", mode="wb") as file:
+                        save_npz(stash_data, file)
+                        file.flush()
+                        os.fsync(file.fileno())
+                else:
+                    with open(path + ".tmp", mode="w", encoding="UTF-8") as file:
+                        json.dump(stash_data, file, ensure_ascii=False, indent=4)
+                        file.flush()
+                        os.fsync(file.fileno())
+                shards = set()
+            os.replace(path + ".tmp", path)
+            with self.lock:
+                if stash_id in self.stashes:
+                    self.stashes[stash_id].update(written=True, labels=None, shards=shards)
+
+    def _delete_stashes(self, released, kept=frozenset()):
+        # runs on the saving thread after the checkpoint restoring or dropping the stashes is written
+        for stash_id, names in released.items():
+            with self.lock:
+                self.stashes.pop(stash_id, None)
+            for path in [stash_path(self.output_path, stash_id)] + [os.path.join(self.output_path, SHARDS_DIR, name) for name in names - kept]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _commit(self, output_file, target_path, saved_seq):
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        output_file.close()
+        os.replace(target_path + ".tmp", target_path)
+        self.journal.truncate(saved_seq)
+        print('Saved to', self.output_path)
+
+    def _failed(self, e, changed):
+        print(f"Saving to {self.output_path} failed: {e}")
+        with self.lock:
+            self.dirty.update(changed)
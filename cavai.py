@@ -7,7 +7,7 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='CAVAI - CT Annotation, Viewing and Analysing Instrument')
     parser.add_argument(
         'destination', 
-        help='path to the json file where labelling will be saved')
+        help='path to the json file where labelling will be saved (.npz for the binary checkpoint format, a directory ending with a separator for the sharded format)')
     parser.add_argument(
         '--series',
         metavar='S',
@@ -19,7 +19,17 @@ def parse_arguments():
     parser.add_argument(
         '--checkpoint',
         metavar='C',
-        help='path to the json file with labelling checkpoint to append to')
+        help='path to the json (binary .npz or sharded directory) file with labelling checkpoint to append to')
+    parser.add_argument(
+        '--autosave',
+        type=float,
+        default=30,
+        help='interval in seconds between background saves of changed series to the destination (0 saves only with "Save Current Boxes")')
+    parser.add_argument(
+        '--compact-every',
+        type=int,
+        default=1000,
+        help='number of journaled box changes after which the destination is saved and the journal is truncated (0 disables)')
     parser.add_argument(
         '--genimages',
         action="store_true",
@@ -54,11 +64,56 @@ def parse_arguments():
         type=str,
         default=None,
         help='name of the folder where generated videos/images will be stored')
+    parser.add_argument(
+        '--window-cache',
+        type=int,
+        default=64,
+        help='number of windowed slices, and of slices resampled to the display size, kept in memory (0 disables caching)')
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=1,
+        help='number of series read ahead in background while images/videos are generated (0 disables prefetching)')
+    parser.add_argument(
+        '--mip-slab',
+        type=int,
+        default=15,
+        help='number of slices in a MIP/MinIP/AvgIP slab (0 for a single projection image of the whole series)')
+    parser.add_argument(
+        '--export-view',
+        type=str,
+        choices=['original', 'mip', 'minip', 'avgip'],
+        default='original',
+        help='view exported to videos/images (slab projections use --mip-slab thickness)')
+    parser.add_argument(
+        '--max-fps',
+        type=float,
+        default=60,
+        help='maximum number of slices rendered per second while scrolling (0 for no limit)')
+    parser.add_argument(
+        '--profile',
+        action="store_true",
+        help='show timings of the rendering stages on the image')
+    parser.add_argument(
+        '--trace',
+        type=str,
+        default=None,
+        help='path to a JSON lines file where timings of every rendering/loading stage are appended')
     parser.add_argument(
         '--sigma',
         type=float,
         default=2.0,
         help='sigma parameter for Laplacian of Gaussian filter')
+    parser.add_argument(
+        '--log-workers',
+        type=int,
+        default=4,
+        help='number of threads precomputing LoG of the whole series in background (0 disables precomputation)')
+    parser.add_argument(
+        '--log-cache-gb',
+        type=float,
+        default=2.0,
+        help='memory limit for precomputed LoG volumes')
     parser.add_argument(
         '--windowed-log',
         action="store_true",
@@ -67,6 +122,44 @@ def parse_arguments():
         '--replace-bg',
         action="store_true",
         help='replace background (-2048) with -1000 before windowing in Laplacian of Gaussian filtering')
+    parser.add_argument(
+        '--load-workers',
+        type=int,
+        default=1,
+        help='number of parallel workers for DICOM header parsing and pixel decoding (1 means serial loading)')
+    parser.add_argument(
+        '--load-executor',
+        type=str,
+        choices=['process', 'thread'],
+        default='process',
+        help='kind of pool used with --load-workers (threads only help if the pixel decoder releases the GIL)')
+    parser.add_argument(
+        '--progressive',
+        action="store_true",
+        help='decode DICOM series in background and show slices as soon as they are decoded')
+    parser.add_argument(
+        '--npy-mmap',
+        action="store_true",
+        help='memory-map .npy slices instead of reading the whole series into memory')
+    parser.add_argument(
+        '--int16',
+        action="store_true",
+        help='keep series as int16 HU (half the memory of float32), values are converted to float only for windowing and filtering')
+    parser.add_argument(
+        '--index',
+        type=str,
+        default=None,
+        help='SQLite index built by series_index.py, folders under indexed parents are opened without header parsing')
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=None,
+        help='folder for caching decoded series, repeated opens of an unchanged folder are read memory-mapped from it')
+    parser.add_argument(
+        '--cache-size-gb',
+        type=float,
+        default=20.0,
+        help='size limit of --cache-dir, least recently used series are evicted above it')
     
     return parser.parse_args()
 
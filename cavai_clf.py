@@ -11,6 +11,7 @@ from tkinter.messagebox import showinfo, showerror, showwarning
 from tkinter import simpledialog, Toplevel, Listbox
 from PIL import Image, ImageTk
 
+from utils import apply_window
 
 
 def get_folder_key(path, last_n=5, short=False, short_cut=3):
@@ -372,7 +373,7 @@ class CTViewer:
 
         minval = self.window_level.get() - (self.window_width.get() / 2)
         maxval = self.window_level.get() + (self.window_width.get() / 2)
-        ct_slice = ((ct_slice - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+        ct_slice = apply_window(ct_slice, minval, maxval)
 
         return Image.fromarray(ct_slice)
 
@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from annotations import BOX_DTYPE, encode_box, decode_boxes
+
+
+# slice entry layouts stored in "slice_layout", other entries are kept whole in the metadata
+LAYOUT_BBOXES_FILENAME = 0  # {"bboxes": [...], "filename": ...} (written by the viewer)
+LAYOUT_FILENAME_BBOXES = 1  # {"filename": ..., "bboxes": [...]}
+LAYOUT_OTHER = 2
+FORMAT_VERSION = 1
+# sharded checkpoint: a directory with MANIFEST and one JSON file per series in SHARDS_DIR
+MANIFEST = "manifest.json"
+SHARDS_DIR = "shards"
+
+
+def _slice_layout(entry):
+    keys = list(entry)
+    if keys == ["bboxes", "filename"] and isinstance(entry["filename"], str):
+        return LAYOUT_BBOXES_FILENAME
+    if keys == ["filename", "bboxes"] and isinstance(entry["filename"], str):
+        return LAYOUT_FILENAME_BBOXES
+    return LAYOUT_OTHER
+
+
+def _str_array(values):
+    return np.array(values, dtype=str) if values else np.zeros(0, dtype='<U1')
+
+
+def save_npz(ct_series_data, file, compress=False):
+    '''
+    Function writes a checkpoint to a .npz container (path or binary file object):
+    one structured array with the boxes of every series and flat tables of series keys, slice keys and filenames
+    '''
+    series_keys, series_n_slices = [], []
+    slice_keys, slice_filenames, slice_layout, slice_n_boxes = [], [], [], []
+    records = []
+    other_entries = {}  # global slice position -> entry with "bboxes" as a placeholder
+    for folder_key, series_labels in ct_series_data["labels"].items():
+        series_keys.append(folder_key)
+        series_n_slices.append(len(series_labels))
+        for slice_key, entry in series_labels.items():
+            layout = _slice_layout(entry)
+            if layout == LAYOUT_OTHER:
+                other_entries[str(len(slice_keys))] = {key: (None if key == "bboxes" else value) for key, value in entry.items()}
+            slice_keys.append(slice_key)
+            slice_filenames.append(entry["filename"] if layout != LAYOUT_OTHER else "")
+            slice_layout.append(layout)
+            bboxes = entry.get("bboxes", [])
+            slice_n_boxes.append(len(bboxes))
+            slice_idx = int(slice_key) if slice_key.isdigit() else -1
+            records.extend(encode_box(slice_idx, bbox) for bbox in bboxes)
+
+    meta = {
+        "format": FORMAT_VERSION,
+        "keys": list(ct_series_data),
+        "values": {key: value for key, value in ct_series_data.items() if key != "labels"},
+        "entries": other_entries,
+    }
+    arrays = {
+        "meta": np.array(json.dumps(meta, ensure_ascii=False)),
+        "series_keys": _str_array(series_keys),
+        "series_n_slices": np.array(series_n_slices, dtype=np.int64),
+        "slice_keys": _str_array(slice_keys),
+        "slice_filenames": _str_array(slice_filenames),
+        "slice_layout": np.array(slice_layout, dtype=np.uint8),
+        "slice_n_boxes": np.array(slice_n_boxes, dtype=np.int64),
+        "boxes": np.array(records, dtype=BOX_DTYPE),
+    }
+    (np.savez_compressed if compress else np.savez)(file, **arrays)
+
+
+def load_npz(file_path):
+    '''
+    Function reads a checkpoint written by save_npz, the result is equal to the JSON checkpoint it was converted from
+    '''
+    with np.load(file_path, allow_pickle=False) as container:
+        meta = json.loads(container["meta"].item())
+        if meta["format"] > FORMAT_VERSION:
+            raise ValueError(f"{file_path} has checkpoint format {meta['format']}, only {FORMAT_VERSION} is supported")
+        series_keys = container["series_keys"].tolist()
+        series_n_slices = container["series_n_slices"].tolist()
+        slice_keys = container["slice_keys"].tolist()
+        slice_filenames = container["slice_filenames"].tolist()
+        slice_layout = container["slice_layout"].tolist()
+        slice_n_boxes = container["slice_n_boxes"].tolist()
+        bboxes = decode_boxes(container["boxes"])
+
+    labels = {}
+    slice_pos = box_pos = 0
+    for folder_key, n_slices in zip(series_keys, series_n_slices):
+        series_labels = labels[folder_key] = {}
+        for i in range(slice_pos, slice_pos + n_slices):
+            slice_bboxes = bboxes[box_pos:box_pos + slice_n_boxes[i]]
+            box_pos += slice_n_boxes[i]
+            if slice_layout[i] == LAYOUT_BBOXES_FILENAME:
+                series_labels[slice_keys[i]] = {"bboxes": slice_bboxes, "filename": slice_filenames[i]}
+            elif slice_layout[i] == LAYOUT_FILENAME_BBOXES:
+                series_labels[slice_keys[i]] = {"filename": slice_filenames[i], "bboxes": slice_bboxes}
+            else:
+                entry = meta["entries"][str(i)]
+                series_labels[slice_keys[i]] = {key: (slice_bboxes if key == "bboxes" else value) for key, value in entry.items()}
+        slice_pos += n_slices
+
+    return {key: (labels if key == "labels" else meta["values"][key]) for key in meta["keys"]}
+
+
+def is_sharded(path):
+    '''
+    Function tells if a checkpoint path is a sharded checkpoint directory (an existing directory or a path ending with a separator)
+    '''
+    return os.path.isdir(path) or path.endswith(("/", os.sep))
+
+
+def shard_name(folder_key, generation):
+    '''
+    Function returns a file name for the shard of a series, a new generation is used for every write of the shard,
+    so the shard referenced by the current manifest is never overwritten
+    '''
+    readable = re.sub(r'[^\w.-]+', '-', folder_key)[-64:]
+    digest = hashlib.sha1(folder_key.encode("UTF-8")).hexdigest()[:8]
+    return f"{readable}_{digest}.{generation}.json"
+
+
+class ShardedLabels(MutableMapping):
+    """
+    "labels" of a sharded checkpoint: folder_key -> series labels, read from the shard of a series on first access.
+
+    `shards` (folder_key -> shard file name, in manifest order) answers keys, `in` and len() without reading shards.
+    Series assigned in memory have no shard (None) until the checkpoint is saved.
+    """
+    def __init__(self, directory, shards):
+        self.directory = directory
+        self.shards = shards
+        self.loaded = {}
+
+    def shard_path(self, folder_key):
+        return os.path.join(self.directory, SHARDS_DIR, self.shards[folder_key])
+
+    def peek(self, folder_key):
+        '''
+        Returns series labels without keeping a shard that has not been read in memory (safe from another thread)
+        '''
+        series_labels = self.loaded.get(folder_key)
+        if series_labels is None:
+            with open(self.shard_path(folder_key), mode='r', encoding='UTF-8') as file:
+                series_labels = json.load(file)
+        return series_labels
+
+    def __getitem__(self, folder_key):
+        if folder_key not in self.loaded:
+            if self.shards.get(folder_key) is None:
+                raise KeyError(folder_key)
+            with open(self.shard_path(folder_key), mode='r', encoding='UTF-8') as file:
+                self.loaded[folder_key] = json.load(file)
+        return self.loaded[folder_key]
+
+    def __setitem__(self, folder_key, series_labels):
+        self.shards.setdefault(folder_key, None)
+        self.loaded[folder_key] = series_labels
+
+    def __delitem__(self, folder_key):
+        del self.shards[folder_key]
+        self.loaded.pop(folder_key, None)
+
+    def __contains__(self, folder_key):
+        return folder_key in self.shards
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def clear(self):
+        self.shards = {}
+        self.loaded = {}
+
+
+def load_sharded(directory, manifest_name=MANIFEST):
+    '''
+    Function reads the manifest of a sharded checkpoint, series are read when they are accessed
+    '''
+    with open(os.path.join(directory, manifest_name), mode='r', encoding='UTF-8') as file:
+        manifest = json.load(file)
+    if manifest["format"] > FORMAT_VERSION:
+        raise ValueError(f"{directory} has checkpoint format {manifest['format']}, only {FORMAT_VERSION} is supported")
+    labels = ShardedLabels(directory, manifest["series"])
+    return {key: (labels if key == "labels" else manifest["values"][key]) for key in manifest["keys"]}
+
+
+def sharded_manifest(ct_series_data, shards):
+    return {
+        "format": FORMAT_VERSION,
+        "keys": list(ct_series_data),
+        "values": {key: value for key, value in ct_series_data.items() if key != "labels"},
+        "series": shards,
+    }
+
+
+def save_sharded(ct_series_data, directory):
+    '''
+    Function writes every series of a checkpoint to its shard and the manifest
+    '''
+    os.makedirs(os.path.join(directory, SHARDS_DIR), exist_ok=True)
+    shards = {}
+    for folder_key, series_labels in ct_series_data["labels"].items():
+        shards[folder_key] = shard_name(folder_key, 0)
+        with open(os.path.join(directory, SHARDS_DIR, shards[folder_key]), mode='w', encoding='UTF-8') as file:
+            json.dump(series_labels, file, ensure_ascii=False, indent=4)
+    with open(os.path.join(directory, MANIFEST), mode='w', encoding='UTF-8') as file:
+        json.dump(sharded_manifest(ct_series_data, shards), file, ensure_ascii=False, indent=4)
+
+
+def stash_path(checkpoint_path, stash_id):
+    '''
+    Function returns the path of the labels stashed by clearing a checkpoint (kept until the clearing can not be undone):
+    a manifest next to the manifest of a sharded checkpoint or a file of the checkpoint format next to the checkpoint
+    '''
+    if is_sharded(checkpoint_path):
+        return os.path.join(checkpoint_path, f"stash-{stash_id}.json")
+    return f"{checkpoint_path}.stash-{stash_id}" + (".npz" if checkpoint_path.endswith(".npz") else ".json")
+
+
+def load_stash(checkpoint_path, stash_id):
+    '''
+    Function returns the labels stashed under stash_id
+    '''
+    if is_sharded(checkpoint_path):
+        return load_sharded(checkpoint_path, manifest_name=os.path.basename(stash_path(checkpoint_path, stash_id)))["labels"]
+    return load_checkpoint(stash_path(checkpoint_path, stash_id))["labels"]
+
+
+def to_dict(ct_series_data):
+    '''
+    Function returns a checkpoint with all series read (plain dictionaries, e.g. for json.dump)
+    '''
+    return {key: (dict(value) if key == "labels" else value) for key, value in ct_series_data.items()}
+
+
+def load_checkpoint(file_path):
+    '''
+    Function reads a JSON, .npz or sharded checkpoint (chosen by extension, a directory is sharded)
+    '''
+    if is_sharded(file_path):
+        return load_sharded(file_path)
+    if file_path.endswith(".npz"):
+        return load_npz(file_path)
+    with open(file_path, mode='r', encoding='UTF-8') as file:
+        return json.load(file)
+
+
+def save_checkpoint(ct_series_data, file_path, compress=False):
+    '''
+    Function writes a JSON, .npz or sharded checkpoint (chosen by extension, a directory is sharded)
+    '''
+    if is_sharded(file_path):
+        save_sharded(ct_series_data, file_path)
+    elif file_path.endswith(".npz"):
+        with open(file_path, mode='wb') as file:
+            save_npz(ct_series_data, file, compress=compress)
+    else:
+        with open(file_path, mode='w', encoding='UTF-8') as file:
+            json.dump(to_dict(ct_series_data), file, ensure_ascii=False, indent=4)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Converts CAVAI checkpoints between JSON, binary .npz and sharded formats (chosen by file extensions, a directory is sharded)')
+    parser.add_argument(
+        'source',
+        help='checkpoint to convert (.json, .npz or a sharded checkpoint directory)')
+    parser.add_argument(
+        'destination',
+        help='converted checkpoint (.json, .npz or a directory ending with a separator for a sharded checkpoint)')
+    parser.add_argument(
+        '--compress',
+        action="store_true",
+        help='compress .npz arrays (smaller file, slower loading)')
+    parser.add_argument(
+        '--check',
+        action="store_true",
+        help='read the converted checkpoint back and compare it with the source')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    ct_series_data = load_checkpoint(args.source)
+    save_checkpoint(ct_series_data, args.destination, compress=args.compress)
+    n_boxes = sum(len(entry.get("bboxes", [])) for series_labels in ct_series_data["labels"].values() for entry in series_labels.values())
+    size = "" if is_sharded(args.destination) else f", {os.path.getsize(args.destination) / 1024**2:.1f} MB"
+    print(f"{args.source} -> {args.destination}: {len(ct_series_data['labels'])} series, {n_boxes} boxes{size}")
+    if args.check:
+        # comparing JSON text also catches 1 -> 1.0 changes, which == does not
+        if json.dumps(to_dict(load_checkpoint(args.destination)), ensure_ascii=False) != json.dumps(to_dict(ct_series_data), ensure_ascii=False):
+            print("Check failed: converted checkpoint differs from the source")
+            exit(1)
+        print("Check passed")
+
+
+if __name__ == "__main__":
+    main()
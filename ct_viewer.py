@@ -4,15 +4,28 @@ import cv2
 import sys
 import os
 import glob
+import time
+import uuid
+from functools import partial
 
 import tkinter as tk
 import numpy as np
-import pydicom
 from tkinter import filedialog, ttk
 from PIL import Image, ImageTk
 from tkinter.messagebox import showerror
 
-from utils import LoG_filter, to_interval, get_folder_key, parse_detected_bboxes, createMIP
+from utils import LoG_response, to_interval, get_folder_key, parse_detected_bboxes, PROJECTIONS, apply_window, LRUCache, WindowedSlices
+from series_loader import create_executor, scan_dicom_series, decode_dicom_series, stack_npy_slices, SliceStack, ProgressiveLoader, SeriesPrefetcher
+from volume_cache import VolumeCache, files_signature, stats_signature
+from series_index import SeriesIndex
+from log_cache import LoGCache
+from filters import FILTERS, FilterChain
+from profiler import Profiler
+from annotations import AnnotationStore
+from journal import CheckpointJournal
+from autosave import Autosaver
+from checkpoint import load_checkpoint, is_sharded
+from dialogs import ask_option
 
 from constants import IMAGE_SIZE
 
@@ -24,14 +37,27 @@ class CTViewer:
         self.bring_window_to_forefront()
 
         self.is_numpy = False
+        self.npy_mmap = args.npy_mmap
+        self.volume_dtype = 'int16' if args.int16 else 'float32'  # HU values are converted to float only when needed
+        self.progressive_loading = args.progressive
+        self.series_loader = None  # ProgressiveLoader of the current series while it is being decoded
+        self.series_cache_entry = None
+        self.placeholder_shown = False
         self.to_show = tk.StringVar(value="original")
         self.artifact_id = 0
         self.ct_series = None  # a 3d numpy array
-        self.ct_series_windowed = None  # a 3d numpy array
-        self.mip_series = None  # a 3d numpy array
-        self.mip_series_windowed = None  # a 3d numpy array
+        self.ct_series_windowed = None  # WindowedSlices of ct_series
+        self.projection_series = None  # a 3d numpy array (slab MIP/MinIP/AvgIP of slab_thickness slices around every slice)
+        self.projection_key = None  # (view, slab_thickness) of projection_series
+        self.projection_series_windowed = None  # WindowedSlices of projection_series
+        self.slab_thickness = args.mip_slab
+        self.projection_cache = LRUCache(3)  # projection volumes by (view, slab_thickness)
+        self.windowed_cache = LRUCache(args.window_cache)  # windowed slices by (slice, level, width, view)
+        self.display_cache = LRUCache(args.window_cache)  # displayed slices resampled to img_size by display_key
 
         self.sigma = args.sigma
+        self.log_cache = LoGCache(args.log_workers, args.log_cache_gb)  # LoG volumes by (view, sigma, windowing)
+        self.filter_chain = FilterChain()  # filters stacked on top of the displayed (windowed or LoG) image
         self.windowed_LoG = args.windowed_log
         self.replace_bg = args.replace_bg
         self.current_log_image = None
@@ -46,6 +72,8 @@ class CTViewer:
         self.bbox_square_threshold = 20
         self.default_level = 0
         self.default_width = 3500
+        self.window_drag_speed = 4  # HU per pixel of right-drag
+        self.window_drag_start = None
 
         self.series_path = args.series
         self.output_path = args.destination
@@ -55,17 +83,63 @@ class CTViewer:
         #self.final_labelling = self.load_json_file(args.checkpoint, default={})
 
         self.ct_series_data = self.load_json_file(args.checkpoint, default={"img_size": IMAGE_SIZE, "labels": {}})
+        # box changes are appended to <destination>.journal, the destination is written in background
+        # every --autosave seconds, on "Save Current Boxes" and after --compact-every changes
+        self.journal = CheckpointJournal(self.output_path, compact_every=args.compact_every)
+        self.autosaver = Autosaver(self.output_path, self.journal, interval=args.autosave, labels=self.ct_series_data["labels"])
+        n_replayed = self.journal.replay(self.ct_series_data)
+        if n_replayed:
+            print(f"Replayed {n_replayed} unsaved box changes from {self.journal.path}")
+            for folder_key in self.journal.replayed_series:
+                self.autosaver.mark_dirty(folder_key)
         self.old_ckpt_labels = None
+        self.old_ckpt_stash = None  # id of the stash keeping self.old_ckpt_labels in the destination
         self.old_series_labels = None
+        # boxes of the current series, synced into self.ct_series_data["labels"] on save and series change
+        self.folder_key = None
+        self.annotations = AnnotationStore()
+        self.item_rows = {}  # canvas item id -> row id of its box in self.annotations
 
         # A set of tkinter ids of bboxes on the current slice
         self.current_bbox_ids = set()
+        # Pools of canvas items (rectangles and max value labels) reused for the boxes of every slice
+        self.box_pool = []
+        self.text_pool = []
+        self.pooled_items = set()
+        self.n_visible_boxes = 0
+        self.n_visible_texts = 0
+
+        self.tk_img = None  # PhotoImage of the canvas, created once and updated with paste
+
+        # timings of the render and loading stages (--profile shows them on the canvas, --trace writes them to a file)
+        self.profiler = Profiler(args.profile, args.trace)
+        self.show_hud = args.profile
+        self.hud_id = None
+        self.resample_display = False  # slices of the series are not img_size x img_size
+        self.display_key = None  # identifies the image returned by get_current_img (slice, view, windowing, LoG, filters)
+
+        # slice changes from the slider, mouse wheel and keys are coalesced into capped-rate renders
+        self.render_pending = False
+        self.min_frame_interval = 1 / args.max_fps if args.max_fps > 0 else 0
+        self.last_render_time = 0
+        self.frames_rendered = 0
+        self.frames_dropped = 0
 
         self.img_size = self.ct_series_data["img_size"]
 
         self.generate_compress = args.gencompress
 
         self.generate_output_folder = args.gen_out_folder
+        self.default_export_view = args.export_view
+
+        # pool for parallel DICOM decoding (None means serial loading)
+        self.load_executor = create_executor(args.load_workers, args.load_executor)
+
+        # SQLite index of DICOM files under big parent folders (--index, built by series_index.py)
+        self.series_index = SeriesIndex(args.index) if args.index else None
+
+        # on-disk cache of decoded volumes (--cache-dir)
+        self.volume_cache = VolumeCache(args.cache_dir, args.cache_size_gb) if args.cache_dir else None
 
         # dictionary with predicted bboxes (--genlabels argument)
         self.detected_bboxes = parse_detected_bboxes(args.genlabels, self.img_size) if args.genlabels else None
@@ -73,7 +147,7 @@ class CTViewer:
             print("self.detected_bboxes length:", len(self.detected_bboxes["labels"]))
 
         #print('Количество серий уникальных ', len(self.ct_series_data["labels"]))
-        print("Series in checkpoint:\n", "\n".join(list(self.ct_series_data["labels"].keys())), sep="")
+        print("Series in checkpoint:", len(self.ct_series_data["labels"]))
 
         #self.artifact_ranges = self.construct_artifact_ranges()
 
@@ -86,27 +160,45 @@ class CTViewer:
             self.show_max_bbox_value.set(1)
 
         if generate_mode is None:
+            self.journal.open(self.ct_series_data)
+            self.autosaver.release_leftover_stashes(self.journal.seq)
+            self.root.after(1000, self.autosave)
+            self.root.protocol("WM_DELETE_WINDOW", self.on_close)
             self.load_ct_series(args.series)
         else:
             if not args.genparent:
                 print("Cannot generate images/videos without parent folder (specify --genparent)")
                 exit(1)
             self.export_as_images.set(1 if generate_mode == 'images' else 0)  # generate_mode is either "images" or "videos"
+            self.progressive_loading = False  # export needs the whole series
             if args.genfile is not None:
                 with open(args.genfile, 'r') as f:
-                    for line in f:
-                        short_folder_key = line.rstrip()
-                        self.load_ct_series(os.path.join(args.genparent, short_folder_key))
-                        self.save_ct_scan_with_boxes()
+                    series_paths = [os.path.join(args.genparent, line.rstrip()) for line in f]
             else:
-                for folder_key in tqdm.tqdm(self.ct_series_data["labels"].keys()):
-                    self.load_ct_series(os.path.join(args.genparent, folder_key))
-                    self.save_ct_scan_with_boxes()
+                series_paths = [os.path.join(args.genparent, folder_key) for folder_key in self.ct_series_data["labels"].keys()]
+            if args.prefetch > 0:
+                # next series are read in background while the current one is exported
+                series_queue = SeriesPrefetcher(series_paths, self.prefetch_series, depth=args.prefetch)
+            else:
+                series_queue = ((series_path, None) for series_path in series_paths)
+            if args.genfile is None:
+                series_queue = tqdm.tqdm(series_queue, total=len(series_paths))
+            for series_path, prefetched in series_queue:
+                self.load_ct_series(series_path, prefetched=prefetched)
+                self.save_ct_scan_with_boxes()
             print("Generation is complete. Exiting...")
+            self.profiler.close()
             exit(0)
 
+    def on_close(self):
+        # flushes the --trace file, unsaved box changes stay in the journal
+        self.profiler.close()
+        self.root.destroy()
+
     def load_json_file(self, file_path, required=False, default=None):
-        if file_path:
+        if file_path and (file_path.endswith(".npz") or is_sharded(file_path)):
+            return load_checkpoint(file_path)  # binary or sharded checkpoint (checkpoint.py)
+        elif file_path:
             with open(file_path, mode='r', encoding='UTF-8') as file:
                 return json.load(file)
         elif required:
@@ -128,7 +220,7 @@ class CTViewer:
         self.canvas_frame = tk.Frame(self.root)
         self.canvas_frame.grid(row=1, column=1, padx=10, sticky="ns")
 
-        self.slider = tk.Scale(self.canvas_frame, from_=0, orient="horizontal", command=self.update_image)    
+        self.slider = tk.Scale(self.canvas_frame, from_=0, orient="horizontal", command=self.request_render)
         self.slider.pack(fill="x")
 
         self.image_canvas = tk.Canvas(self.canvas_frame, height=self.img_size, width=self.img_size, cursor="cross")
@@ -138,6 +230,10 @@ class CTViewer:
         self.image_canvas.bind("<ButtonPress-1>", self.on_box_start)
         self.image_canvas.bind("<B1-Motion>", self.on_box_drag)
         self.image_canvas.bind("<ButtonRelease-1>", self.on_box_release)
+        # Bindings of boxes are registered once for the "bbox" tag
+        self.image_canvas.tag_bind("bbox", '<Button-2>', lambda event: self.on_rectangle_click(event, self.get_event_item()))
+        self.image_canvas.tag_bind("bbox", '<Control-Button-2>', lambda event: self.set_interpolation_box(event, self.get_event_item(), 1))
+        self.image_canvas.tag_bind("bbox", '<Option-Button-2>', lambda event: self.set_interpolation_box(event, self.get_event_item(), 2))
 
         self.root.bind("<space>", self.interpolate)
 
@@ -145,6 +241,11 @@ class CTViewer:
         self.image_canvas.bind("<MouseWheel>", self.on_scroll)
         # Bind motion event to the image label
         self.image_canvas.bind("<Motion>", self.show_pixel_value)
+        # Bind right-drag to window/level adjustment (Button-2 is the right button on macOS)
+        right_button = 2 if self.root.tk.call("tk", "windowingsystem") == "aqua" else 3
+        self.image_canvas.bind(f"<ButtonPress-{right_button}>", self.on_window_drag_start)
+        self.image_canvas.bind(f"<B{right_button}-Motion>", self.on_window_drag)
+        self.image_canvas.bind(f"<ButtonRelease-{right_button}>", self.on_window_drag_release)
 
         self.root.bind('<Left>', self.prev_image)
         self.root.bind('<Right>', self.next_image)
@@ -180,6 +281,19 @@ class CTViewer:
         self.apply_LoG = tk.IntVar()
         ttk.Checkbutton(self.left_controls_frame, text=f"Apply LoG", variable=self.apply_LoG, command=self.update_image).pack(pady=2)
 
+        #   LoG sigma
+        vcmd_sigma = self.root.register(self.validate_sigma)
+        self.sigma_frame = ttk.Frame(self.left_controls_frame)
+        self.sigma_frame.pack(fill="x", pady=5)
+
+        self.sigma_label = ttk.Label(self.sigma_frame, text="LoG Sigma:")
+        self.sigma_label.pack(side="left")
+
+        self.sigma_entry = ttk.Entry(self.sigma_frame, validate="key", validatecommand=(vcmd_sigma, '%P'), width=10)
+        self.sigma_entry.insert(0, str(self.sigma))  # Insert default value
+        self.sigma_entry.bind("<Return>", self.update_sigma)  # Bind the Enter key
+        self.sigma_entry.pack(side="left", expand=False, fill="x")
+
         # LoG windowing
         #   Window Min
         vcmd_log_min = self.root.register(self.validate_window_level)
@@ -207,14 +321,47 @@ class CTViewer:
         self.log_window_max_entry.bind("<Return>", self.update_log_window)  # Bind the Enter key
         self.log_window_max_entry.pack(side="left", expand=False, fill="x")
 
+        # Filter chain
+        self.filter_frame = ttk.Frame(self.left_controls_frame)
+        self.filter_frame.pack(fill="x", pady=5)
+
+        self.filter_name = tk.StringVar(value="gaussian")
+        self.filter_combobox = ttk.Combobox(self.filter_frame, textvariable=self.filter_name, values=list(FILTERS), state="readonly", width=9)
+        self.filter_combobox.bind("<<ComboboxSelected>>", self.select_filter)
+        self.filter_combobox.pack(side="left")
+
+        self.filter_param_entry = ttk.Entry(self.filter_frame, width=5)
+        self.filter_param_entry.insert(0, str(FILTERS["gaussian"][1]))  # Insert default value
+        self.filter_param_entry.pack(side="left", expand=False, fill="x")
+
+        ttk.Button(self.left_controls_frame, text="Add filter", command=self.add_filter).pack(pady=2)
+        ttk.Button(self.left_controls_frame, text="Clear filters", command=self.clear_filters).pack(pady=2)
+        self.filter_chain_label = ttk.Label(self.left_controls_frame, text=f"Filters: {self.filter_chain}", wraplength=150)
+        self.filter_chain_label.pack(pady=2)
+
 
         # Controls on right side
         self.right_controls_frame = tk.Frame(self.root)
         self.right_controls_frame.grid(row=1, column=2, padx=10, sticky="n")
 
         ttk.Radiobutton(self.right_controls_frame, state=tk.NORMAL, text="Show MIP", value="mip", variable=self.to_show, command=self.toggle_view).pack(pady=5)
+        ttk.Radiobutton(self.right_controls_frame, state=tk.NORMAL, text="Show MinIP", value="minip", variable=self.to_show, command=self.toggle_view).pack(pady=5)
+        ttk.Radiobutton(self.right_controls_frame, state=tk.NORMAL, text="Show AvgIP", value="avgip", variable=self.to_show, command=self.toggle_view).pack(pady=5)
         ttk.Radiobutton(self.right_controls_frame, state=tk.ACTIVE, text="Show original", value="original", variable=self.to_show, command=self.toggle_view).pack(pady=5)
 
+        #   Slab thickness of projections
+        vcmd_slab = self.root.register(self.validate_slab_thickness)
+        self.slab_frame = ttk.Frame(self.right_controls_frame)
+        self.slab_frame.pack(fill="x", pady=5)
+
+        self.slab_label = ttk.Label(self.slab_frame, text="Slab (0 - all):")
+        self.slab_label.pack(side="left")
+
+        self.slab_entry = ttk.Entry(self.slab_frame, validate="key", validatecommand=(vcmd_slab, '%P'), width=5)
+        self.slab_entry.insert(0, str(self.slab_thickness))  # Insert default value
+        self.slab_entry.bind("<Return>", self.update_slab_thickness)  # Bind the Enter key
+        self.slab_entry.pack(side="left", expand=False, fill="x")
+
         self.add_window_info = tk.IntVar()
         ttk.Checkbutton(self.right_controls_frame, text=f"Include window info", variable=self.add_window_info).pack(pady=10)
 
@@ -227,10 +374,19 @@ class CTViewer:
         self.export_as_images = tk.IntVar()
         ttk.Checkbutton(self.right_controls_frame, text=f"Export boxes as images", variable=self.export_as_images).pack(pady=2)
 
+        self.export_view_frame = ttk.Frame(self.right_controls_frame)
+        self.export_view_frame.pack(fill="x", pady=2)
+        ttk.Label(self.export_view_frame, text="Export view:").pack(side="left")
+        self.export_view = tk.StringVar(value=self.default_export_view)
+        ttk.Combobox(self.export_view_frame, textvariable=self.export_view, values=["original", *PROJECTIONS], state="readonly", width=8).pack(side="left")
+
         # Label to display pixel value
         self.pixel_value_label = ttk.Label(self.right_controls_frame, text="Pixel Value: N/A")
         self.pixel_value_label.pack(pady=5)
 
+        self.frames_label = ttk.Label(self.right_controls_frame, text="Frames rendered/dropped: 0/0")
+        self.frames_label.pack(pady=2)
+
         self.show_max_bbox_value = tk.IntVar()
         ttk.Checkbutton(self.right_controls_frame, text=f"Show max bbox value", variable=self.show_max_bbox_value).pack(pady=2)
 
@@ -304,25 +460,32 @@ class CTViewer:
         - series_name: The name of the CT scan series to display on each frame.
         - output_filename_video: The name of the output video file.
         """
+        if self.series_loader is not None:
+            showerror("Error", "The series is still loading")
+            return
+
         # Define the codec and create VideoWriter object
         def to_window(img):
-            minval = int(self.window_level_entry.get()) - (int(self.window_width_entry.get()) / 2)
-            maxval = int(self.window_level_entry.get()) + (int(self.window_width_entry.get()) / 2)
-            img = ((img - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
-            return img
+            window_level, window_width = self.get_window()
+            return apply_window(img, window_level - (window_width / 2), window_level + (window_width / 2))
 
         export_as_images = bool(self.export_as_images.get())
-        folder_key = get_folder_key(self.series_path)
+        folder_key = self.folder_key
+
+        # slices of the original series or of a slab projection
+        export_view = self.export_view.get()
+        frames = self.ct_series if export_view == "original" else self.get_projection(export_view)
+        view_info = f"_{export_view}" if export_view != "original" else ""
 
         parent_path = [os.path.dirname(os.path.realpath(__file__))]
         if self.generate_output_folder is not None:
             parent_path.append(self.generate_output_folder)
 
         if export_as_images:
-            output_folder = os.path.join(*parent_path, "-".join(f"{get_folder_key(self.series_path, short=True)}_export".split(os.sep)))
+            output_folder = os.path.join(*parent_path, "-".join(f"{get_folder_key(self.series_path, short=True)}{view_info}_export".split(os.sep)))
             os.makedirs(output_folder, exist_ok=True)
         else:
-            output_filename_video = os.path.join(*parent_path, "-".join(f"{get_folder_key(self.series_path, short=True)}_vid.mp4".split(os.sep)))
+            output_filename_video = os.path.join(*parent_path, "-".join(f"{get_folder_key(self.series_path, short=True)}{view_info}_vid.mp4".split(os.sep)))
             os.makedirs(os.path.join(*parent_path), exist_ok=True)
 
         frame_height, frame_width = self.ct_series[0].shape[0], self.ct_series[0].shape[1]
@@ -334,38 +497,49 @@ class CTViewer:
         tl = 1  # line/font thickness
         tf = max(tl - 1, 1)  # font thickness
 
-        # Iterate through each frame in the CT scan
-        for current_idx, frame in enumerate(self.ct_series):
-
-            frame = to_window(frame)
+        def filtered_frames():
+            # windowed (or LoG) frames go through the filter chain in batches,
+            # frames already filtered for display are taken from the chain cache
+            view_key, window = self.get_view_key(export_view), self.get_window()
+            batch, keys = [], []
+            for current_idx, frame in enumerate(frames):
+                if self.apply_LoG.get():
+                    frame = self.window_log(LoG_response(to_window(frame) if self.windowed_LoG else frame, self.sigma, self.replace_bg))
+                    keys.append(None)
+                else:
+                    frame = to_window(frame)
+                    keys.append((view_key, window, current_idx))
+                batch.append(frame)
+                if len(batch) == self.filter_chain.batch_size:
+                    yield from self.filter_chain.apply_batch(batch, keys)
+                    batch, keys = [], []
+            yield from self.filter_chain.apply_batch(batch, keys)
 
-            if self.apply_LoG.get():
-                frame = self.get_current_img()
+        # Iterate through each frame in the CT scan
+        for current_idx, frame in enumerate(filtered_frames()):
 
             # Convert grayscale frame to BGR for colored drawing
             frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
 
             # Redraw bounding boxes if they exist for the current slice    
-            if folder_key in self.ct_series_data["labels"]:
-                if str(current_idx) in self.ct_series_data["labels"][folder_key]:
-                    for bbox in self.ct_series_data["labels"][folder_key][str(current_idx)]["bboxes"]:
-                        _, start_x, start_y, end_x, end_y = bbox
+            for _, bbox in self.annotations.boxes(current_idx):
+                _, start_x, start_y, end_x, end_y = bbox
 
-                        # ground truth (green)
-                        cv2.rectangle(frame, (int(start_x), int(start_y)), (int(end_x), int(end_y)), (0, 255, 0), 1)
+                # ground truth (green)
+                cv2.rectangle(frame, (int(start_x), int(start_y)), (int(end_x), int(end_y)), (0, 255, 0), 1)
 
 
-                        # showing max value for the box
-                        if self.show_max_bbox_value.get():
-                            max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
-                            label = f'{max_value:,}'.replace(',', ' ')
+                # showing max value for the box
+                if self.show_max_bbox_value.get():
+                    max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
+                    label = f'{max_value:,}'.replace(',', ' ')
                             
-                            font_color = [0, 0, 255]
-                            t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
-                            filler_end_x, filler_end_y = start_x + t_size[0], start_y - t_size[1] - 3
+                    font_color = [0, 0, 255]
+                    t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+                    filler_end_x, filler_end_y = start_x + t_size[0], start_y - t_size[1] - 3
     
-                            cv2.rectangle(frame, (int(start_x), int(start_y)), (int(filler_end_x), int(filler_end_y)), (0, 255, 255), -1, cv2.LINE_AA)  # filled
-                            cv2.putText(frame, label, (int(start_x), int(start_y) - 2), 0, 0.3, font_color, thickness=1, lineType=cv2.LINE_AA)
+                    cv2.rectangle(frame, (int(start_x), int(start_y)), (int(filler_end_x), int(filler_end_y)), (0, 255, 255), -1, cv2.LINE_AA)  # filled
+                    cv2.putText(frame, label, (int(start_x), int(start_y) - 2), 0, 0.3, font_color, thickness=1, lineType=cv2.LINE_AA)
 
 
             # drawing bboxes from predictions (generated by a trained model)
@@ -409,12 +583,23 @@ class CTViewer:
         print(f"Successfully saved the {'images' if export_as_images else 'video'} to", output_folder if export_as_images else output_filename_video)
 
     def update_labelled_series(self):
-        self.n_labelled.config(text=f'Labelled series: {len(self.ct_series_data["labels"])}')
+        labels = self.ct_series_data["labels"]
+        n = len(labels) - (self.folder_key in labels) + bool(self.annotations)
+        self.n_labelled.config(text=f'Labelled series: {n}')
 
     def update_labelled_slices(self):
-        folder_key = get_folder_key(self.series_path)
-        n = len(self.ct_series_data["labels"][folder_key]) if folder_key in self.ct_series_data["labels"] else 0
-        self.text_with_art.config(text=f'Slices with artefacts: {n}')
+        self.text_with_art.config(text=f'Slices with artefacts: {self.annotations.n_slices}')
+
+    def sync_annotations(self):
+        '''
+        Writes the boxes of the current series into self.ct_series_data["labels"]
+        '''
+        if self.folder_key is None:
+            return
+        if self.annotations:
+            self.ct_series_data["labels"][self.folder_key] = self.annotations.to_json()
+        else:
+            self.ct_series_data["labels"].pop(self.folder_key, None)
 
     def update_log_window(self, _=None):
         self.log_window_min = int(self.log_window_min_entry.get())
@@ -423,34 +608,137 @@ class CTViewer:
         self.lose_focus()
         self.update_image()
 
-    def update_windowing(self, _=None):
+    def select_filter(self, _=None):
+        self.filter_param_entry.delete(0, tk.END)
+        self.filter_param_entry.insert(0, str(FILTERS[self.filter_name.get()][1]))
+        self.lose_focus()
+
+    def add_filter(self):
+        try:
+            param = float(self.filter_param_entry.get())
+        except ValueError:
+            showerror("Error", f"Invalid {FILTERS[self.filter_name.get()][2]}: {self.filter_param_entry.get()}")
+            return
+        try:
+            self.filter_chain.add(self.filter_name.get(), param)
+        except ValueError as e:
+            # checked before the filter enters the chain, a failing filter would break every redraw
+            showerror("Error", str(e))
+            return
+        self.filter_chain_label.config(text=f"Filters: {self.filter_chain}")
+        self.update_image()
+
+    def clear_filters(self):
+        self.filter_chain.clear()
+        self.filter_chain_label.config(text=f"Filters: {self.filter_chain}")
+        self.update_image()
+
+    def validate_sigma(self, value):
+        return not value or value.replace('.', '', 1).isdigit()
+
+    def update_sigma(self, _=None):
+        try:
+            sigma = float(self.sigma_entry.get())
+        except ValueError:
+            return
+        if sigma > 0:
+            self.sigma = sigma
+        self.lose_focus()
+        self.update_image()
+
+    def validate_slab_thickness(self, value):
+        return not value or value.isdigit()
+
+    def update_slab_thickness(self, _=None):
+        try:
+            slab_thickness = int(self.slab_entry.get())
+        except ValueError:
+            return
+        self.lose_focus()
+        if slab_thickness == self.slab_thickness:
+            return
+        self.slab_thickness = slab_thickness
+        if self.ct_series is not None:
+            self.toggle_view()
+
+    def get_projection(self, view):
+        with self.profiler.stage("projection"):
+            return self.projection_cache.get((view, self.slab_thickness), lambda: PROJECTIONS[view](self.ct_series, self.slab_thickness))
+
+    def update_projection(self):
+        '''
+        Makes projection_series match the current view, projections are computed on first selection
+        (never while the series is still loading) and kept in projection_cache
+        '''
+        view = self.to_show.get()
+        if view not in PROJECTIONS or self.series_loader is not None or self.projection_key == (view, self.slab_thickness):
+            return
+        self.projection_series = self.get_projection(view)
+        self.projection_key = (view, self.slab_thickness)
+        self.update_windowing()
+
+    def get_window(self):
         try:
             window_level = int(self.window_level_entry.get())
             window_width = int(self.window_width_entry.get())
         except:
             window_level = self.default_level
             window_width = self.default_width
+        return window_level, window_width
 
-        minval = window_level - (window_width / 2)
-        maxval = window_level + (window_width / 2)
-        if self.ct_series is not None:
-            self.ct_series_windowed = ((self.ct_series - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
-        if self.mip_series is not None:
-            self.mip_series_windowed = ((self.mip_series - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+    def set_window(self, window_level, window_width):
+        self.window_level_entry.delete(0, tk.END)
+        self.window_level_entry.insert(0, str(window_level))
+        self.window_width_entry.delete(0, tk.END)
+        self.window_width_entry.insert(0, str(window_width))
+
+    def update_windowing(self, _=None):
+        window_level, window_width = self.get_window()
+
+        # slices are windowed when displayed, recently shown ones are kept in windowed_cache
+        with self.profiler.stage("update_windowing"):
+            if self.ct_series is not None:
+                self.ct_series_windowed = WindowedSlices(self.ct_series, window_level, window_width, "original", self.windowed_cache)
+            if self.projection_series is not None:
+                self.projection_series_windowed = WindowedSlices(self.projection_series, window_level, window_width, self.projection_key, self.windowed_cache)
+            else:
+                self.projection_series_windowed = None
         self.lose_focus()
         self.update_image()
 
     def save_boxes(self):
-        with open(self.output_path, mode="w", encoding="UTF-8") as output_file:
-            json.dump(self.ct_series_data, output_file, ensure_ascii=False, indent=4)
+        self.sync_annotations()
+        if not self.autosaver.save(self.ct_series_data):
+            print('Previous save is in progress, saving again when it completes')
         self.update_labelled_series()
-        print('Saved to', self.output_path)
+
+    def autosave(self):
+        # due() can stay true during a save (a requested save, changes made meanwhile), syncing waits for the save to finish
+        if not self.autosaver.busy and (self.autosaver.due() or self.journal.needs_compaction()):
+            self.sync_annotations()
+            self.autosaver.save(self.ct_series_data)
+        self.root.after(1000, self.autosave)
+
+    def record_change(self, op, series=None, **fields):
+        '''
+        Journals a change of the labels and marks its series for the next autosave (series=None for all series)
+        '''
+        self.journal.append(op, **({} if series is None else {"series": series}), **fields)
+        self.autosaver.mark_dirty(series)
 
     def clear_boxes_checkpoint(self):
+        self.sync_annotations()
         if not self.ct_series_data["labels"]:
             return
-        self.old_ckpt_labels = self.ct_series_data["labels"]
+        # the journal references the cleared labels, the autosaver keeps them as a stash until undo is no longer possible
+        stash_id = uuid.uuid4().hex
+        self.record_change("clear", stash=stash_id)
+        self.autosaver.add_stash(stash_id, self.ct_series_data["labels"], self.journal.seq)
+        if self.old_ckpt_stash is not None:
+            self.autosaver.release_stash(self.old_ckpt_stash, self.journal.seq)
+        self.old_ckpt_labels, self.old_ckpt_stash = self.ct_series_data["labels"], stash_id
         self.ct_series_data["labels"] = {}
+        self.annotations = AnnotationStore()
         self.update_labelled_series()
         self.update_labelled_slices()
         self.update_image()
@@ -459,18 +747,21 @@ class CTViewer:
         if not self.old_ckpt_labels:
             return
         self.ct_series_data["labels"] = self.old_ckpt_labels
-        self.old_ckpt_labels = {}
+        self.record_change("restore", stash=self.old_ckpt_stash)
+        self.autosaver.release_stash(self.old_ckpt_stash, self.journal.seq)
+        self.old_ckpt_labels, self.old_ckpt_stash = {}, None
+        self.annotations = AnnotationStore.from_json(self.ct_series_data["labels"].get(self.folder_key, {}))
         self.update_labelled_series()
         self.update_labelled_slices()
         self.update_image()
 
     def clear_boxes_series(self):
-        folder_key = get_folder_key(self.series_path)
-        if folder_key not in self.ct_series_data["labels"]:
+        if not self.annotations:
             return
-        self.old_series_labels = self.ct_series_data["labels"][folder_key]    
-        #self.ct_series_data["labels"][folder_key] = {}
-        self.ct_series_data["labels"].pop(folder_key)
+        self.old_series_labels = self.annotations
+        self.annotations = AnnotationStore()
+        self.ct_series_data["labels"].pop(self.folder_key, None)
+        self.record_change("set_series", self.folder_key, labels={})
         self.update_labelled_series()
         self.update_labelled_slices()
         self.update_image()
@@ -478,9 +769,9 @@ class CTViewer:
     def undo_clear_boxes_series(self):
         if not self.old_series_labels:
             return
-        folder_key = get_folder_key(self.series_path)
-        self.ct_series_data["labels"][folder_key] = self.old_series_labels
+        self.annotations = self.old_series_labels
         self.old_series_labels = None
+        self.record_change("set_series", self.folder_key, labels=self.annotations.to_json())
         self.update_labelled_series()
         self.update_labelled_slices()
         self.update_image()
@@ -518,9 +809,8 @@ class CTViewer:
         if not self.last_interpolation:
             return
         for current_idx, (artifact_id, start_x, start_y, end_x, end_y) in self.last_interpolation:
-            folder_key = get_folder_key(self.series_path)
             bbox = [artifact_id, start_x, start_y, end_x, end_y]
-            self.delete_box(folder_key, current_idx, bbox)
+            self.delete_box(current_idx, bbox)
         self.update_image()
         self.last_interpolation = []
 
@@ -528,9 +818,8 @@ class CTViewer:
         if not self.last_removal:
             return
         for current_idx, (artifact_id, start_x, start_y, end_x, end_y) in self.last_removal:
-            folder_key = get_folder_key(self.series_path)
             bbox = [artifact_id, start_x, start_y, end_x, end_y]
-            self.add_box(folder_key, current_idx, bbox)
+            self.add_box(current_idx, bbox)
         self.update_image()
         self.last_removal = []
 
@@ -562,9 +851,8 @@ class CTViewer:
             end_y = round(end_y1 + (end_y2 - end_y1) * t, 1)
 
             current_idx = idx1 + i * step
-            folder_key = get_folder_key(self.series_path)
             bbox = [self.artifact_id, start_x, start_y, end_x, end_y]
-            self.add_box(folder_key, current_idx, bbox)
+            self.add_box(current_idx, bbox)
             self.last_interpolation.append((current_idx, bbox))
 
         self.inter_box_1 = None
@@ -592,8 +880,6 @@ class CTViewer:
     
         # Calculate the number of slices to interpolate
         num_slices = abs(idx2 - idx1) - 1
-
-        folder_key = get_folder_key(self.series_path)
     
         # Loop through each slice and interpolate the bounding box
         for i in range(0, num_slices):
@@ -607,16 +893,16 @@ class CTViewer:
 
             current_idx = idx1 + i * step
             
-            if folder_key in self.ct_series_data["labels"] and str(current_idx) in self.ct_series_data["labels"][folder_key]:
-                for bbox in self.ct_series_data["labels"][folder_key][str(current_idx)]["bboxes"]:
-                    art_id, in_start_x, in_start_y, in_end_x, in_end_y = bbox
-                    if start_x < in_start_x and start_y < in_start_y and end_x > in_end_x and end_y > in_end_y:
-                        self.delete_box(folder_key, current_idx, bbox)
-                        self.last_removal.append((current_idx, bbox))
+            for row, bbox in self.annotations.boxes(current_idx):
+                art_id, in_start_x, in_start_y, in_end_x, in_end_y = bbox[:5]
+                if start_x < in_start_x and start_y < in_start_y and end_x > in_end_x and end_y > in_end_y:
+                    self.remove_box_row(row)
+                    self.last_removal.append((current_idx, bbox))
 
         # delete inter boxes
-        self.delete_box(folder_key, idx1, [self.artifact_id] + self.inter_box_1[1])
-        self.delete_box(folder_key, idx2, [self.artifact_id] + self.inter_box_2[1])
+        self.delete_box(idx1, [self.artifact_id] + self.inter_box_1[1])
+        self.delete_box(idx2, [self.artifact_id] + self.inter_box_2[1])
+        self.update_labelled_slices()
 
         self.inter_box_1 = None
         self.inter_box_2 = None
@@ -628,6 +914,25 @@ class CTViewer:
         self.lose_focus()
 
 
+    def on_window_drag_start(self, event):
+        if self.image_canvas.type("current") == "rectangle":
+            return  # right click on a box deletes it
+        self.window_drag_start = (event.x, event.y, *self.get_window())
+
+    def on_window_drag(self, event):
+        # horizontal movement changes width, vertical movement changes level
+        if self.window_drag_start is None or self.ct_series is None:
+            return
+        start_x, start_y, window_level, window_width = self.window_drag_start
+        window_level = int(window_level + (event.y - start_y) * self.window_drag_speed)
+        window_width = max(1, int(window_width + (event.x - start_x) * self.window_drag_speed))
+        if (window_level, window_width) != self.get_window():
+            self.set_window(window_level, window_width)
+            self.update_windowing()
+
+    def on_window_drag_release(self, event):
+        self.window_drag_start = None
+
     def on_box_start(self, event):
         # Start drawing a bounding box
         self.start_x = self.image_canvas.canvasx(event.x)
@@ -639,7 +944,9 @@ class CTViewer:
         end_x = self.image_canvas.canvasx(event.x)
         end_y = self.image_canvas.canvasy(event.y)
 
-        target_list = self.get_current_viewtype()
+        target_list = self.get_current_viewtype(windowed=False)
+        if target_list is None:
+            return  # the projection is not computed yet
 
         if 0 <= end_x < target_list[0].shape[1] and 0 <= end_y < target_list[0].shape[0]:
             self.image_canvas.coords(self.current_box, self.start_x, self.start_y, end_x, end_y)
@@ -649,7 +956,11 @@ class CTViewer:
 
         start_x, start_y, end_x, end_y = self.image_canvas.coords(rect_id)
 
-        self.image_canvas.delete(rect_id)  # remove from the canvas
+        # remove from the canvas (pooled items are hidden until they are reused)
+        if rect_id in self.pooled_items:
+            self.image_canvas.itemconfig(rect_id, state="hidden")
+        else:
+            self.image_canvas.delete(rect_id)
 
         if str(event.type) == '5':
         #if square <= self.bbox_square_threshold:
@@ -658,57 +969,44 @@ class CTViewer:
             print("on_rectangle_click triggered with release")
             return
 
-        folder_key = get_folder_key(self.series_path)
-        bbox = [self.artifact_id, start_x, start_y, end_x, end_y]
-        self.delete_box(folder_key, current_idx, bbox)
+        row = self.item_rows.pop(rect_id, None)
+        if row is not None and row in self.annotations.slices.get(current_idx, ()):
+            self.remove_box_row(row)
+            self.update_labelled_slices()
+        else:
+            bbox = [self.artifact_id, start_x, start_y, end_x, end_y]
+            self.delete_box(current_idx, bbox)
         self.current_bbox_ids.remove(rect_id)
 
-    def delete_box(self, folder_key, slice_idx, bbox):
+    def delete_box(self, slice_idx, bbox):
         """
         bbox = [self.artifact_id, start_x, start_y, end_x, end_y]
         """
-        try:
-            # Assuming self.ct_series_data is a nested dictionary and you're trying to access and modify a list within it
-            folder_key = get_folder_key(self.series_path)
-            if folder_key in self.ct_series_data["labels"] and str(slice_idx) in self.ct_series_data["labels"][folder_key]:
-                
-                if bbox in self.ct_series_data["labels"][folder_key][str(slice_idx)]["bboxes"]:
-                    self.ct_series_data["labels"][folder_key][str(slice_idx)]["bboxes"].remove(bbox)
-                    if len(self.ct_series_data["labels"][folder_key][str(slice_idx)]["bboxes"]) == 0:
-                        del self.ct_series_data["labels"][folder_key][str(slice_idx)]
-                    if len(self.ct_series_data["labels"][folder_key]) == 0:
-                        del self.ct_series_data["labels"][folder_key]
-
-                    self.update_labelled_slices()
-                else:
-                    print(f"Error: Specified bounding box not found in the list ({bbox})")
-            else:
-                print("Error: Folder key or current index not found in the data.")
-        except KeyError as e:
-            print(f"Key error occurred: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+        row = self.annotations.find(slice_idx, bbox)
+        if row is not None:
+            self.remove_box_row(row)
+            self.update_labelled_slices()
+        elif slice_idx in self.annotations.slices:
+            print(f"Error: Specified bounding box not found in the list ({bbox})")
+        else:
+            print("Error: Folder key or current index not found in the data.")
 
-    def add_box(self, folder_key, slice_idx, bbox):
+    def remove_box_row(self, row):
+        slice_idx = int(self.annotations.rows["slice"][row])
+        self.record_change("remove", self.folder_key, slice=slice_idx, bbox=self.annotations.bbox(row))
+        self.annotations.remove(row)
+
+    def add_box(self, slice_idx, bbox):
         """
         bbox = [self.artifact_id, start_x, start_y, end_x, end_y]
+        Returns the row id of the box in self.annotations
         """
         # Store the bounding box coordinates for the current slice
         try:
-            # Ensure that the folder key exists in the dictionary
-            if folder_key not in self.ct_series_data["labels"]:
-                self.ct_series_data["labels"][folder_key] = {}
-        
-            # Ensure that the current index exists in the nested dictionary
-            if str(slice_idx) not in self.ct_series_data["labels"][folder_key]:
-                self.ct_series_data["labels"][folder_key][str(slice_idx)] = {"bboxes": []}
-        
-            # Add the bbox to the list of bboxes for the current index
-            self.ct_series_data["labels"][folder_key][str(slice_idx)]["bboxes"].append(bbox)
-            self.ct_series_data["labels"][folder_key][str(slice_idx)]["filename"] = self.idx_to_name[slice_idx]
-
+            row = self.annotations.add(slice_idx, bbox, filename=self.idx_to_name[slice_idx])
+            self.record_change("add", self.folder_key, slice=slice_idx, bbox=self.annotations.bbox(row), filename=self.idx_to_name[slice_idx])
             self.update_labelled_slices()
-
+            return row
         except KeyError as e:
             print(f"Key error occurred: {e}")
         except Exception as e:
@@ -741,9 +1039,7 @@ class CTViewer:
         #target_list = self.get_current_viewtype()
 
         self.image_canvas.coords(self.current_box, final_start_x, final_start_y, final_end_x, final_end_y)
-        self.image_canvas.tag_bind(self.current_box, '<Button-2>', lambda event, rect_id=self.current_box: self.on_rectangle_click(event, rect_id))
-        self.image_canvas.tag_bind(self.current_box, '<Control-Button-2>', lambda event, rect_id=self.current_box: self.set_interpolation_box(event, rect_id, 1))
-        self.image_canvas.tag_bind(self.current_box, '<Option-Button-2>', lambda event, rect_id=self.current_box: self.set_interpolation_box(event, rect_id, 2))
+        self.image_canvas.addtag_withtag("bbox", self.current_box)  # box bindings are registered for the tag
 
         tl = 1  # line/font thickness
         tf = max(tl - 1, 1)  # font thickness
@@ -760,9 +1056,8 @@ class CTViewer:
             self.current_bbox_ids.add(text_id)
 
         
-        folder_key = get_folder_key(self.series_path)
         bbox = [self.artifact_id, final_start_x, final_start_y, final_end_x, final_end_y]
-        self.add_box(folder_key, current_idx, bbox)
+        self.item_rows[self.current_box] = self.add_box(current_idx, bbox)
         self.current_bbox_ids.add(self.current_box)
 
     def set_interpolation_box(self, event, rect_id, box_n):
@@ -786,23 +1081,63 @@ class CTViewer:
 
     def get_current_img(self):
         slice_idx = self.slider.get()
+        if self.series_loader is not None:
+            slice_idx = min(len(self.ct_series)-1, slice_idx)
+            self.series_loader.focus = slice_idx
+            if self.to_show.get() != "original" or not self.series_loader.loaded[slice_idx]:
+                # the slice is not decoded yet
+                self.placeholder_shown = True
+                self.display_key = "placeholder"
+                return np.zeros(self.ct_series.shape[1:], dtype='uint8')
+        self.placeholder_shown = False
+
         if self.apply_LoG.get():
             target_list = self.get_current_viewtype(windowed=self.windowed_LoG)
             slice_idx = min(len(target_list)-1, slice_idx)
-            ct_slice = target_list[slice_idx]
-            if self.replace_bg:
-                ct_slice = ct_slice.copy()
-                ct_slice[ct_slice == -2048.0] = -1000.
-            self.current_log_image = LoG_filter(ct_slice, self.sigma)
-            minval = self.log_window_min
-            maxval = self.log_window_max  # 700 - 1200
-            self.current_log_image = ((self.current_log_image - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+            log_key, log_source, log_fn = self.get_log_volume()
+            with self.profiler.stage("log"):
+                if self.series_loader is None:
+                    # the whole volume is filtered in background, slices which are not ready yet are filtered here
+                    self.log_cache.request(log_key, len(log_source), log_source.__getitem__, log_fn)
+                self.current_log_image = self.log_cache.get(log_key, slice_idx)
+                if self.current_log_image is None:
+                    self.current_log_image = log_fn(target_list[slice_idx])
+                self.current_log_image = self.window_log(self.current_log_image)
             ct_slice = self.current_log_image
+            filter_key = (log_key, self.log_window_min, self.log_window_max, slice_idx)
         else:
             target_list = self.get_current_viewtype()
             slice_idx = min(len(target_list)-1, slice_idx)
-            ct_slice = target_list[slice_idx]
-        return ct_slice
+            with self.profiler.stage("windowing"):
+                ct_slice = target_list[slice_idx]
+            filter_key = (self.get_view_key(), self.get_window(), slice_idx)
+        self.display_key = (filter_key, self.filter_chain.config())
+        # filters stacked in the UI, results are memoised per slice and filter chain
+        with self.profiler.stage("filters"):
+            return self.filter_chain.apply(ct_slice, filter_key)
+
+    def window_log(self, log_image):
+        minval = self.log_window_min
+        maxval = self.log_window_max  # 700 - 1200
+        return ((log_image - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+
+    def get_view_key(self, view=None):
+        view = view or self.to_show.get()
+        return "original" if view == "original" else (view, self.slab_thickness)
+
+    def get_log_volume(self):
+        '''
+        Returns (key, slices, filter) of the LoG volume of the current view and LoG settings
+        '''
+        view_key = self.get_view_key()
+        window = self.get_window() if self.windowed_LoG else None
+        key = (view_key, self.sigma, self.windowed_LoG, self.replace_bg, window)
+        source = self.get_current_viewtype(windowed=False)
+        if self.windowed_LoG:
+            # an uncached view, as windowed_cache is not shared with the worker threads
+            window_level, window_width = window
+            source = WindowedSlices(source, window_level, window_width, view_key)
+        return key, source, partial(LoG_response, sigma=self.sigma, replace_bg=self.replace_bg)
 
     def save_current_view(self):
         if self.ct_series is None:
@@ -812,33 +1147,30 @@ class CTViewer:
 
         slice_idx = self.slider.get()
         #img_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "-".join(f"{get_folder_key(self.series_path)}_{slice_idx}.png".split(os.sep)))
-        mip = "_mip" if self.to_show.get() == "mip" else ""
+        view_info = f"_{self.to_show.get()}" if self.to_show.get() != "original" else ""
         window_info = f"_L={int(self.window_level_entry.get())}_W={int(self.window_width_entry.get())}" if self.add_window_info.get() else ""
-        img_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "-".join(f"{get_folder_key(self.series_path, short=True)}_{slice_idx}{mip}{window_info}.png".split(os.sep)))
+        img_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "-".join(f"{get_folder_key(self.series_path, short=True)}_{slice_idx}{view_info}{window_info}.png".split(os.sep)))
 
-        folder_key = get_folder_key(self.series_path)
         current_idx = self.slider.get()
         tl = 1  # line/font thickness
         tf = max(tl - 1, 1)  # font thickness
 
-        if folder_key in self.ct_series_data["labels"]:
-            if str(current_idx) in self.ct_series_data["labels"][folder_key]:
-                for bbox in self.ct_series_data["labels"][folder_key][str(current_idx)]["bboxes"]:
-                    _, start_x, start_y, end_x, end_y = bbox
+        for _, bbox in self.annotations.boxes(current_idx):
+            _, start_x, start_y, end_x, end_y = bbox
 
-                    cv2.rectangle(rgb_img, (int(start_x), int(start_y)), (int(end_x), int(end_y)), (0, 255, 255), 1)
+            cv2.rectangle(rgb_img, (int(start_x), int(start_y)), (int(end_x), int(end_y)), (0, 255, 255), 1)
                     
-                    # showing max value for the box
-                    if self.show_max_bbox_value.get():
-                        max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
-                        label = f'{max_value:,}'.replace(',', ' ')
+            # showing max value for the box
+            if self.show_max_bbox_value.get():
+                max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
+                label = f'{max_value:,}'.replace(',', ' ')
                         
-                        font_color = [0, 0, 255]
-                        t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
-                        filler_end_x, filler_end_y = start_x + t_size[0], start_y - t_size[1] - 3
+                font_color = [0, 0, 255]
+                t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+                filler_end_x, filler_end_y = start_x + t_size[0], start_y - t_size[1] - 3
 
-                        cv2.rectangle(rgb_img, (int(start_x), int(start_y)), (int(filler_end_x), int(filler_end_y)), (0, 255, 255), -1, cv2.LINE_AA)  # filled
-                        cv2.putText(rgb_img, label, (int(start_x), int(start_y) - 2), 0, 0.3, font_color, thickness=1, lineType=cv2.LINE_AA)
+                cv2.rectangle(rgb_img, (int(start_x), int(start_y)), (int(filler_end_x), int(filler_end_y)), (0, 255, 255), -1, cv2.LINE_AA)  # filled
+                cv2.putText(rgb_img, label, (int(start_x), int(start_y) - 2), 0, 0.3, font_color, thickness=1, lineType=cv2.LINE_AA)
 
 
         cv2.imwrite(img_path, rgb_img)
@@ -858,28 +1190,53 @@ class CTViewer:
     
         new_value = self.slider.get() + increment
         if 0 <= new_value < len(self.ct_series):  # Ensure the new value is within bounds
-            self.slider.set(new_value)
-        self.update_image()
+            self.slider.set(new_value)  # the slider command schedules the render
 
     def prev_image(self, event):
         target_list = self.get_current_viewtype()
+        if target_list is None:
+            return  # the projection is not computed yet
         new_value = self.slider.get() - 1
         if 0 <= new_value < len(target_list):  # Ensure the new value is within bounds
-            self.slider.set(new_value)
-            self.update_image()
+            self.slider.set(new_value)  # the slider command schedules the render
 
     def next_image(self, event):
         target_list = self.get_current_viewtype()
+        if target_list is None:
+            return  # the projection is not computed yet
         new_value = self.slider.get() + 1
         if 0 <= new_value < len(target_list):  # Ensure the new value is within bounds
-            self.slider.set(new_value)
-            self.update_image()
+            self.slider.set(new_value)  # the slider command schedules the render
+
+    def request_render(self, _=None):
+        '''
+        Schedules rendering of the slice under the slider, requests made before the pending render runs are dropped
+        (the render shows the latest slice anyway), renders are at most max_fps per second
+        '''
+        if self.render_pending:
+            self.frames_dropped += 1
+            return
+        self.render_pending = True
+        delay = self.last_render_time + self.min_frame_interval - time.perf_counter()
+        if delay > 0:
+            self.root.after(int(delay * 1000) + 1, self.render_frame)
+        else:
+            self.root.after_idle(self.render_frame)
+
+    def render_frame(self):
+        self.render_pending = False
+        self.last_render_time = time.perf_counter()
+        self.frames_rendered += 1
+        self.update_image()
+        self.frames_label.config(text=f"Frames rendered/dropped: {self.frames_rendered}/{self.frames_dropped}")
 
     def get_current_viewtype(self, windowed=True):
         if self.to_show.get() == "original":
             return self.ct_series_windowed if windowed else self.ct_series
-        if self.to_show.get() == "mip":
-            return self.mip_series_windowed  if windowed else self.mip_series
+        if self.to_show.get() in PROJECTIONS:
+            if self.projection_key != (self.to_show.get(), self.slab_thickness):
+                return None  # not computed yet
+            return self.projection_series_windowed if windowed else self.projection_series
         raise NotImplemented("unknown view: "+self.to_show.get())
 
     def show_pixel_value(self, event):
@@ -892,18 +1249,23 @@ class CTViewer:
             # Check if the coordinates are within bounds
             if 0 <= x < target_list[0].shape[1] and 0 <= y < target_list[0].shape[0]:
                 slice_idx = self.slider.get()
+                if self.series_loader is not None and not self.series_loader.loaded[slice_idx]:
+                    self.pixel_value_label.config(text="Pixel Value: N/A")
+                    return
                 if self.apply_LoG.get() and self.current_log_image is not None:
                     ct_slice = self.current_log_image 
                 else:
                     ct_slice = target_list[slice_idx]
                 pixel_value = ct_slice[y, x]
-                self.pixel_value_label.config(text=f"Pixel Value: {pixel_value:.2f} {'(LoG)' if self.apply_LoG.get() else ''}")
+                self.pixel_value_label.config(text=f"Pixel Value: {float(pixel_value):.2f} {'(LoG)' if self.apply_LoG.get() else ''}")
             else:
                 self.pixel_value_label.config(text="Pixel Value: N/A")
 
     def toggle_view(self, _=None):
+        self.update_projection()
+
         target_list = self.get_current_viewtype()
-        if self.to_show.get() == "mip":
+        if self.to_show.get() in PROJECTIONS:
             self.interpolate_button.config(state="disable")
             self.undo_interpolation_button.config(state="disable")
             self.remove_boxes_button.config(state="disable")
@@ -914,7 +1276,8 @@ class CTViewer:
             self.remove_boxes_button.config(state="normal")
             self.undo_remove_boxes_button.config(state="normal")
 
-        self.slider.config(to=len(target_list)-1)
+        if target_list is not None:
+            self.slider.config(to=len(target_list)-1)
         self.update_image()
 
     def update_image(self, _=None):
@@ -922,170 +1285,263 @@ class CTViewer:
             return
 
         # Get the current CT image
-        img = self.get_current_img()
-        img = Image.fromarray(img)
-        width, height = img.size
-
-        if width != self.img_size or height != self.img_size:
-            img = img.resize((self.img_size, self.img_size))
-
-        # Convert the image to a format suitable for Tkinter
-        self.tk_img = ImageTk.PhotoImage(image=img)
-        ####
-        ##### If an image is already displayed on the canvas, remove it
-        ####if hasattr(self, 'canvas_img_id'):
-        ####    self.image_canvas.delete(self.canvas_img_id)
-        ####
-        ##### Display the new image on the canvas
-        ####self.canvas_img_id = self.image_canvas.create_image(0, 0, anchor="nw", image=self.tk_img)
-
-        # Delete old bboxes
-        for rect_id in self.current_bbox_ids:
-            self.image_canvas.delete(rect_id)
-        self.current_bbox_ids.clear()
-        
-        # Check if the canvas image item has been created
-        if not hasattr(self, 'canvas_img_id'):
-            # If not, create the canvas image item and store its ID
+        with self.profiler.stage("get_current_img"):
+            img = self.get_current_img()
+        if self.resample_display:
+            # slices of another size are resampled once, revisited slices are taken from display_cache
+            with self.profiler.stage("resize"):
+                img = self.display_cache.get(self.display_key, partial(cv2.resize, img, (self.img_size, self.img_size), interpolation=cv2.INTER_CUBIC))
+
+        # Pixel data is pasted into one persistent PhotoImage shown by the canvas image item
+        if self.tk_img is None:
+            self.tk_img = ImageTk.PhotoImage("L", (self.img_size, self.img_size))
             self.canvas_img_id = self.image_canvas.create_image(0, 0, anchor="nw", image=self.tk_img)
-        else:
-            # If the canvas image item exists, update its image
-            self.image_canvas.itemconfig(self.canvas_img_id, image=self.tk_img)
+        with self.profiler.stage("paste"):
+            self.tk_img.paste(Image.fromarray(img))
+
+        with self.profiler.stage("boxes"):
+            self.draw_boxes()
+
+        if self.profiler.enabled:
+            self.profiler.frame()
+            self.update_hud()
+
+    def update_hud(self):
+        # timings of the render stages in the top left corner of the canvas (--profile)
+        if not self.show_hud:
+            return
+        if self.hud_id is None:
+            self.hud_id = self.image_canvas.create_text(4, 4, anchor="nw", fill="yellow", font=("Courier", 9), tags=("hud",))
+        self.image_canvas.itemconfig(self.hud_id, text=self.profiler.summary())
+        self.image_canvas.tag_raise(self.hud_id)
+
+    def draw_boxes(self):
+        # Delete boxes drawn by hand on the previous slice, pooled items are reused below
+        for item_id in self.current_bbox_ids - self.pooled_items:
+            self.image_canvas.delete(item_id)
+            self.item_rows.pop(item_id, None)
+        self.current_bbox_ids.clear()
+        n_boxes = n_texts = 0
 
         # Update the canvas scroll region to accommodate the new image
         #self.image_canvas.config(height=height, width=width)
 
         # Redraw bounding boxes if they exist for the current slice
-        folder_key = get_folder_key(self.series_path)
         current_idx = self.slider.get()
 
-        if folder_key in self.ct_series_data["labels"]:
-            if str(current_idx) in self.ct_series_data["labels"][folder_key]:
-                for bbox in self.ct_series_data["labels"][folder_key][str(current_idx)]["bboxes"]:
-                    _, start_x, start_y, end_x, end_y = bbox
-                    # properly processing boxes selected for interpolation
-                    if self.inter_box_1 is not None and bbox[1:] == self.inter_box_1[1] and current_idx == self.inter_box_1[0] or \
-                       self.inter_box_2 is not None and bbox[1:] == self.inter_box_2[1] and current_idx == self.inter_box_2[0]:
-                        color = "green2"
-                    else:
-                        color = "red"
-                    self.current_box = self.image_canvas.create_rectangle(start_x, start_y, end_x, end_y, outline=color)
-                    self.image_canvas.tag_bind(self.current_box, '<Button-2>', lambda event, rect_id=self.current_box: self.on_rectangle_click(event, rect_id))
-                    self.image_canvas.tag_bind(self.current_box, '<Control-Button-2>', lambda event, rect_id=self.current_box: self.set_interpolation_box(event, rect_id, 1))
-                    self.image_canvas.tag_bind(self.current_box, '<Option-Button-2>', lambda event, rect_id=self.current_box: self.set_interpolation_box(event, rect_id, 2))
-                    self.current_bbox_ids.add(self.current_box)
-                    # showing max value for the box
-                    if self.show_max_bbox_value.get():
-                        max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
-                        formatted_max_value = f'{max_value:,}'.replace(',', ' ')
-                        # h=12, w=7 for font=("Courier", 9)
-                        semiwidth = len(formatted_max_value) * 7 // 2
-                        offset_x = semiwidth - end_x if end_x < semiwidth else (semiwidth - (self.img_size - end_x) if self.img_size - end_x < semiwidth else 0)
-                        offset_y = 7
-                        text_id = self.image_canvas.create_text(end_x + offset_x, start_y - offset_y, text=formatted_max_value, fill="red", font=("Courier", 9))
-                        self.current_bbox_ids.add(text_id)
-
-
-
-
-    def load_ct_series(self, path=None):
-        if not path:
-            path = filedialog.askdirectory(title="Select Folder Containing CT Series", initialdir=os.path.realpath(__file__))
-            self.root.focus_set()
-            self.root.lift()
-            if not path:
-                return
+        for row, bbox in self.annotations.boxes(current_idx):
+            _, start_x, start_y, end_x, end_y = bbox
+            # properly processing boxes selected for interpolation
+            if self.inter_box_1 is not None and bbox[1:] == self.inter_box_1[1] and current_idx == self.inter_box_1[0] or \
+               self.inter_box_2 is not None and bbox[1:] == self.inter_box_2[1] and current_idx == self.inter_box_2[0]:
+                color = "green2"
+            else:
+                color = "red"
+            rect_id = self.get_pooled_item(self.box_pool, n_boxes)
+            n_boxes += 1
+            self.image_canvas.coords(rect_id, start_x, start_y, end_x, end_y)
+            self.image_canvas.itemconfig(rect_id, outline=color, state="normal")
+            self.current_bbox_ids.add(rect_id)
+            self.item_rows[rect_id] = row
+            # showing max value for the box
+            if self.show_max_bbox_value.get():
+                max_value = int(self.ct_series[current_idx][to_interval(start_y-1):to_interval(end_y-1), to_interval(start_x-1):to_interval(end_x-1)].max())
+                formatted_max_value = f'{max_value:,}'.replace(',', ' ')
+                # h=12, w=7 for font=("Courier", 9)
+                semiwidth = len(formatted_max_value) * 7 // 2
+                offset_x = semiwidth - end_x if end_x < semiwidth else (semiwidth - (self.img_size - end_x) if self.img_size - end_x < semiwidth else 0)
+                offset_y = 7
+                text_id = self.get_pooled_item(self.text_pool, n_texts)
+                n_texts += 1
+                self.image_canvas.coords(text_id, end_x + offset_x, start_y - offset_y)
+                self.image_canvas.itemconfig(text_id, text=formatted_max_value, state="normal")
+                self.current_bbox_ids.add(text_id)
+
+        # hiding pooled items left from the previous slice
+        for item_id in self.box_pool[n_boxes:self.n_visible_boxes] + self.text_pool[n_texts:self.n_visible_texts]:
+            self.image_canvas.itemconfig(item_id, state="hidden")
+        self.n_visible_boxes, self.n_visible_texts = n_boxes, n_texts
+
+    def get_pooled_item(self, pool, idx):
+        '''
+        Returns canvas item idx of the box (or box label) pool, creating it when the pool is too small
+        '''
+        if idx == len(pool):
+            if pool is self.box_pool:
+                item_id = self.image_canvas.create_rectangle(0, 0, 0, 0, outline="red", tags=("bbox",))
+            else:
+                item_id = self.image_canvas.create_text(0, 0, fill="red", font=("Courier", 9), tags=("bbox_text",))
+            pool.append(item_id)
+            self.pooled_items.add(item_id)
+        return pool[idx]
 
+    def get_event_item(self):
+        # canvas item under the pointer (the box a tag binding was triggered for)
+        return self.image_canvas.find_withtag("current")[0]
 
-        ct_series_old = self.ct_series
-        series_path_old = self.series_path
-        #artifact_ranges_old = self.artifact_ranges
-        self.ct_series = []
-        self.series_path = None
-        self.is_numpy = False
-        self.root.lift()
 
-        series = {} # SeriesInstanceUID
+    def find_series(self, path):
+        """
+        Finds series in a folder reading DICOM headers only.
+
+        Returns (series_path, is_numpy, series, signature), where series maps SeriesInstanceUID
+        to a list of file paths in slice order and signature is None unless the volume cache is used.
+        Folders covered by an up-to-date series index (--index) are resolved without parsing headers.
+        """
+        indexed = self.series_index.lookup(path) if self.series_index is not None else None
+        if indexed is not None:
+            series, file_stats = indexed
+            signature = None
+            if self.volume_cache is not None:
+                signature = stats_signature(os.path.realpath(path), file_stats)
+                # drops cached volumes of a changed folder
+                series = self.volume_cache.lookup(path, signature) or series
+            return None, False, series, signature
+
+        series_path = None
+        is_numpy = False
+
+        npy_files = []
+        dicom_files = []
 
 
         for root_dir, _, files in os.walk(path):
             files = list(filter(lambda x: x[0] != '.', files))
             if 'npy' in root_dir:
-                images = []  # a list of tuples (idx, filename, img_array)
-                self.is_numpy = True
-                for file in files:
-                    image = np.load(os.path.join(root_dir, file))
-                    slice_idx = int(file.split('.')[0])
-                    images.append((slice_idx, file, image))
-                self.series_path = root_dir
+                is_numpy = True
+                npy_files = [os.path.join(root_dir, file) for file in files]
+                series_path = root_dir
             else:
-                for file in files:
-                    try:
-                        dcm = pydicom.dcmread(os.path.join(root_dir, file))
-                        if dcm[0x00080060].value != 'CT': # checking modality
-                            continue
-                        #if hasattr(dcm, "SliceLocation"):
-                        if not hasattr(dcm, "ImagePositionPatient"):
-                            continue
-                        if dcm.SeriesInstanceUID in series:
-                            series[dcm.SeriesInstanceUID].append((file, dcm))
-                        else:
-                            series[dcm.SeriesInstanceUID] = [(file, dcm)]
-                        if not self.series_path:
-                            self.series_path = root_dir
-                    except Exception as e:
-                        print(f'Could not read file {file}, error:', e)
-
-        if self.is_numpy:
-            # idk why but .npy series start from neck (0 slice) and end up in stomach (last slice)
-            # that is why these sequences are sorted in reverse order
-            images.sort(key=lambda x: x[0], reverse=True)
-            self.ct_series = [img for idx, filename, img in images]
-            self.idx_to_name = {i: filename for i, (idx, filename, img) in enumerate(images)}
-            self.name_to_idx = {filename: i for i, (idx, filename, img) in enumerate(images)}
+                dicom_files.extend(os.path.join(root_dir, file) for file in files)
+
+        series = None
+        signature = None
+        if self.volume_cache is not None:
+            signature = files_signature(path, npy_files + dicom_files)
+            series = self.volume_cache.lookup(path, signature)
+
+        if is_numpy:
+            if series is None:
+                # idk why but .npy series start from neck (0 slice) and end up in stomach (last slice)
+                # that is why these sequences are sorted in reverse order
+                npy_files.sort(key=lambda file_path: int(os.path.basename(file_path).split('.')[0]), reverse=True)
+                series = {"npy": npy_files}
+        elif series is None:
+            # only headers are read here, pixel data is decoded for the chosen series only
+            headers = scan_dicom_series(dicom_files, self.load_executor)
+            series = {series_uid: [header.file_path for header in sorted(series_headers, key=lambda header: header.z)]
+                      for series_uid, series_headers in headers.items()}
+
+        return series_path, is_numpy, series, signature
+
+    def read_volume(self, path, signature, series, chosen_series, is_numpy):
+        volume = self.volume_cache.load_volume(path, chosen_series, self.volume_dtype) if self.volume_cache is not None else None
+        if volume is not None:
+            return volume
+
+        file_paths = series[chosen_series]
+        if is_numpy and self.npy_mmap:
+            return SliceStack(file_paths)
+        if is_numpy:
+            volume = stack_npy_slices(file_paths, self.volume_dtype)
         else:
-            if not series:
-                showerror("Error", f"No series in {path} has been found")
-                self.ct_series = ct_series_old
-                self.series_path = series_path_old
-                #self.artifact_ranges = artifact_ranges_old
+            volume = decode_dicom_series(file_paths, self.load_executor, self.volume_dtype)
+        if self.volume_cache is not None:
+            self.volume_cache.store(path, signature, series, chosen_series, volume)
+        return volume
+
+    def prefetch_series(self, path):
+        """
+        Reads a series for load_ct_series(path, prefetched=...) without touching the UI, so it can run in a SeriesPrefetcher.
+        Folders with several series are only scanned, their volume is read after the user chooses one.
+        """
+        series_path, is_numpy, series, signature = self.find_series(path)
+        chosen_series = None
+        volume = None
+        if len(series) == 1:
+            chosen_series = list(series.keys())[0]
+            volume = self.read_volume(path, signature, series, chosen_series, is_numpy)
+        return series_path, is_numpy, series, signature, chosen_series, volume
+
+    def load_ct_series(self, path=None, prefetched=None):
+        if not path:
+            path = filedialog.askdirectory(title="Select Folder Containing CT Series", initialdir=os.path.realpath(__file__))
+            self.root.focus_set()
+            self.root.lift()
+            if not path:
                 return
-    
+
+        self.root.lift()
+
+        # the current series stays untouched until the new one is chosen
+        if prefetched is None:
+            with self.profiler.stage("find_series"):
+                prefetched = self.find_series(path) + (None, None)
+        series_path, is_numpy, series, signature, chosen_series, volume = prefetched
+
+        if not series:
+            showerror("Error", f"No series in {path} has been found")
+            return
+
+        if chosen_series is None:
             chosen_series = ask_option(self.root, list(series.keys()), "Choose the series") if len(series) > 1 else list(series.keys())[0]
             if chosen_series is None:
-                self.ct_series = ct_series_old
-                self.series_path = series_path_old
-                #self.artifact_ranges = artifact_ranges_old
                 return
-            series[chosen_series].sort(key=lambda x: float(x[1].ImagePositionPatient[2]))
-            self.idx_to_name = {i: filename for i, (filename, dcm) in enumerate(series[chosen_series])}
-            self.name_to_idx = {filename: i for i, (filename, dcm) in enumerate(series[chosen_series])}
-            series[chosen_series] = [pydicom.pixel_data_handlers.apply_modality_lut(dcm.pixel_array, dcm).astype('float32') for filename, dcm in series[chosen_series]]
-            for image in series[chosen_series]:
-                # Making all paddings have the same value
-                image[image.astype(int) == -3024] = -2048.
-            self.ct_series = series[chosen_series]
-
-        self.ct_series = np.stack(self.ct_series, axis=0)
-        
-        self.mip_series = [createMIP(np.stack(self.ct_series, axis=0))]
-        self.mip_series = np.stack(self.mip_series, axis=0)
-
+        if not is_numpy:
+            series_path = os.path.dirname(series[chosen_series][0])
+
+        if self.series_loader is not None:
+            # dropping the unfinished progressive load of the previous series
+            self.series_loader.cancel()
+            self.series_loader = None
+        self.sync_annotations()
+        self.series_path = series_path
+        self.folder_key = get_folder_key(series_path)
+        self.annotations = AnnotationStore.from_json(self.ct_series_data["labels"].get(self.folder_key, {}))
+        self.item_rows = {}
+        self.is_numpy = is_numpy
+
+        file_paths = series[chosen_series]
+        self.idx_to_name = {i: os.path.basename(file_path) for i, file_path in enumerate(file_paths)}
+        self.name_to_idx = {os.path.basename(file_path): i for i, file_path in enumerate(file_paths)}
+
+        if volume is None and self.progressive_loading and not self.is_numpy:
+            volume = self.volume_cache.load_volume(path, chosen_series, self.volume_dtype) if self.volume_cache is not None else None
+            if volume is None:
+                # slices are decoded in background starting from the one under the slider
+                self.series_loader = ProgressiveLoader(file_paths, self.load_executor, focus=self.slider.get(), dtype=self.volume_dtype)
+                volume = self.series_loader.volume
+                self.series_cache_entry = (path, signature, series, chosen_series) if self.volume_cache is not None else None
+                self.root.after(50, self.poll_series_loading, self.series_loader)
+        if volume is None:
+            with self.profiler.stage("read_volume"):
+                volume = self.read_volume(path, signature, series, chosen_series, self.is_numpy)
+        self.ct_series = volume
+        self.resample_display = np.shape(self.ct_series[0]) != (self.img_size, self.img_size)
+        self.windowed_cache.clear()
+        self.display_cache.clear()
+        self.log_cache.clear()
+        self.filter_chain.clear_cache()
+        self.projection_cache.clear()
+
+        # projections are computed when their view is selected
+        self.projection_series = None
+        self.projection_key = None
         self.update_windowing()
+        self.update_projection()
 
         target_list = self.get_current_viewtype()
 
-        self.slider.config(to=len(target_list)-1)
-
-        folder_key = get_folder_key(self.series_path)
+        # projections of a progressively loaded series are available only when the loading is complete
+        self.slider.config(to=len(target_list)-1 if target_list is not None else 0)
 
         if self.series_labels:
-            possible_artifacts = '\n'.join(self.series_labels[get_folder_key(self.series_path)]) \
-                if get_folder_key(self.series_path) in self.series_labels else "not available"
+            possible_artifacts = '\n'.join(self.series_labels[self.folder_key]) \
+                if self.folder_key in self.series_labels else "not available"
         else:
             possible_artifacts = "not available"
 
-        self.folder_key_label.config(text=get_folder_key(self.series_path)+'\n'+"Possible artifacts: \n"+possible_artifacts, font=("Courier", 12))
+        self.folder_key_label.config(text=self.folder_key+'\n'+"Possible artifacts: \n"+possible_artifacts, font=("Courier", 12))
 
         self.text_series_len.config(text=f'Series length: {len(self.ct_series)}')
         self.update_labelled_slices()
@@ -1093,3 +1549,22 @@ class CTViewer:
         self.old_series_labels = None
         self.update_image()
         self.root.focus_set()
+
+    def poll_series_loading(self, loader):
+        if loader is not self.series_loader:
+            return  # another series has been opened
+
+        if not loader.done:
+            # showing the slice under the slider as soon as it is decoded
+            if self.placeholder_shown and self.to_show.get() == "original" and loader.loaded[min(self.slider.get(), len(loader.loaded)-1)]:
+                self.update_image()
+            self.root.after(50, self.poll_series_loading, loader)
+            return
+
+        self.series_loader = None
+        if self.series_cache_entry is not None:
+            path, signature, series, chosen_series = self.series_cache_entry
+            self.volume_cache.store(path, signature, series, chosen_series, self.ct_series)
+            self.series_cache_entry = None
+        self.update_windowing()
+        self.toggle_view()
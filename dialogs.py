@@ -1,4 +1,5 @@
-from tkinter import simpledialog
+import tkinter as tk
+from tkinter import simpledialog, Listbox
 
 
 class CustomDialog(simpledialog.Dialog):
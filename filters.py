@@ -0,0 +1,130 @@
+import math
+
+import cv2
+import numpy as np
+
+from utils import LoG_filter, LRUCache
+
+
+# Filters work on uint8 display images. A batch is a (height, width, n) array with one slice per channel,
+# OpenCV filters channels independently, so a batch is filtered with a single call.
+# Filters without multi-channel support (median, CLAHE) are run slice by slice.
+
+def gaussian_filter(images, sigma):
+    return cv2.GaussianBlur(images, (0, 0), sigma)
+
+
+def log_filter(images, sigma):
+    return LoG_filter(images, sigma)
+
+
+def clahe_filter(images, clip_limit):
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
+    return np.dstack([clahe.apply(np.ascontiguousarray(images[..., i])) for i in range(images.shape[2])])
+
+
+def median_filter(images, size):
+    size = max(3, int(size) // 2 * 2 + 1)  # odd aperture
+    return np.dstack([cv2.medianBlur(np.ascontiguousarray(images[..., i]), size) for i in range(images.shape[2])])
+
+
+def gradient_filter(images, ksize):
+    ksize = min(7, max(1, int(ksize) // 2 * 2 + 1))  # Sobel aperture 1, 3, 5 or 7
+    dx = cv2.Sobel(images, cv2.CV_32F, 1, 0, ksize=ksize)
+    dy = cv2.Sobel(images, cv2.CV_32F, 0, 1, ksize=ksize)
+    return np.sqrt(dx**2 + dy**2).clip(0, 255).astype(np.uint8)
+
+
+def threshold_filter(images, value):
+    return np.where(images > value, 255, 0).astype(np.uint8)
+
+
+# name: (function, default parameter, parameter name, parameter must be positive)
+FILTERS = {
+    "gaussian": (gaussian_filter, 1.0, "sigma", True),
+    "log": (log_filter, 2.0, "sigma", True),
+    "clahe": (clahe_filter, 2.0, "clip limit", True),
+    "median": (median_filter, 3, "size", True),
+    "gradient": (gradient_filter, 3, "kernel size", True),
+    "threshold": (threshold_filter, 127, "value", False),
+}
+
+
+class FilterChain:
+    """
+    Ordered list of (filter name, parameter) applied to uint8 display images.
+
+    Results are memoised under (key, chain config), where the key identifies the input image
+    (view, slice, windowing), so revisited slices and exports reuse the filtered images.
+    """
+    def __init__(self, cache_size=256, batch_size=32):
+        self.filters = []
+        self.cache = LRUCache(cache_size)
+        self.batch_size = batch_size
+
+    def __bool__(self):
+        return bool(self.filters)
+
+    def __str__(self):
+        return " > ".join(f"{name}({param:g})" for name, param in self.filters) or "none"
+
+    def add(self, name, param=None):
+        '''
+        Appends a filter, raises ValueError for a parameter the filter can not use
+        '''
+        _, default, param_name, positive = FILTERS[name]
+        param = float(default if param is None else param)
+        if not math.isfinite(param) or (positive and param <= 0):
+            raise ValueError(f"{name} {param_name} must be a{' positive' if positive else ''} finite number, got {param:g}")
+        self.filters.append((name, param))
+
+    def clear(self):
+        self.filters = []
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    def config(self):
+        return tuple(self.filters)
+
+    def run(self, images):
+        '''
+        Applies the chain to a (height, width, n) batch of uint8 images
+        '''
+        for name, param in self.filters:
+            images = FILTERS[name][0](images, param)
+            if images.ndim == 2:
+                images = images[..., np.newaxis]  # OpenCV drops a single channel axis
+        return images
+
+    def apply(self, image, key=None):
+        if not self.filters:
+            return image
+        if key is None:
+            return self.apply_batch([image])[0]
+        return self.cache.get((key, self.config()), lambda: self.apply_batch([image])[0])
+
+    def apply_batch(self, images, keys=None):
+        '''
+        Applies the chain to a list of uint8 images, images found in cache (by keys) are not filtered again,
+        the others are filtered in batches of batch_size slices
+        '''
+        if not self.filters:
+            return images
+        config = self.config()
+        results = [None] * len(images)
+        missing = []
+        for i in range(len(images)):
+            if keys is not None and keys[i] is not None and (keys[i], config) in self.cache:
+                results[i] = self.cache.get((keys[i], config), None)
+            else:
+                missing.append(i)
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            filtered = self.run(np.dstack([images[i] for i in batch]))
+            for channel, i in enumerate(batch):
+                results[i] = np.ascontiguousarray(filtered[..., channel])
+                if keys is not None and keys[i] is not None:
+                    self.cache.put((keys[i], config), results[i])
+        return results
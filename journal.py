@@ -0,0 +1,178 @@
+import os
+import json
+import uuid
+import threading
+
+from checkpoint import load_stash
+
+
+def apply_operation(labels, op):
+    '''
+    Function applies a journal operation to a checkpoint "labels" dictionary
+    '''
+    kind = op["op"]
+    if kind == "add":
+        slice_entry = labels.setdefault(op["series"], {}).setdefault(str(op["slice"]), {"bboxes": []})
+        slice_entry["bboxes"].append(op["bbox"])
+        slice_entry["filename"] = op["filename"]
+    elif kind == "remove":
+        series_labels = labels.get(op["series"], {})
+        slice_entry = series_labels.get(str(op["slice"]))
+        if slice_entry is not None and op["bbox"] in slice_entry["bboxes"]:
+            slice_entry["bboxes"].remove(op["bbox"])
+            if not slice_entry["bboxes"]:
+                del series_labels[str(op["slice"])]
+            if not series_labels:
+                del labels[op["series"]]
+    elif kind == "set_series":
+        if op["labels"]:
+            labels[op["series"]] = op["labels"]
+        else:
+            labels.pop(op["series"], None)
+    elif kind == "set_labels":
+        labels.clear()
+        labels.update(op["labels"])
+    else:
+        raise ValueError(f"unknown journal operation {kind}")
+
+
+class CheckpointJournal:
+    """
+    Append-only journal of box changes next to a JSON checkpoint (<checkpoint>.journal).
+
+    Every change is appended as a JSON line with a sequence number and synced to disk, which is cheap
+    compared to rewriting the checkpoint. A checkpoint written by the viewer stores the id of its journal
+    ("journal_id") and the last sequence number it contains ("journal_seq"), startup replays only the later
+    operations, so the journal can be truncated after the checkpoint is written (`truncate`) and a crash
+    in between does not replay operations twice.
+    """
+    def __init__(self, checkpoint_path, compact_every=1000):
+        self.checkpoint_path = checkpoint_path
+        self.path = checkpoint_path + ".journal"
+        self.compact_every = compact_every
+        self.file = None
+        self.id = None
+        self.seq = 0
+        self.saved_seq = 0  # last sequence number in the checkpoint
+        self.replayed_series = set()  # series changed by replay (None when all labels were replaced)
+        self.lock = threading.Lock()  # appends come from the Tk thread, truncation from the saving thread
+
+    def _read(self):
+        with open(self.path, mode="r", encoding="UTF-8") as file:
+            lines = file.read().splitlines()
+        header = json.loads(lines[0]) if lines else {}
+        ops = []
+        for i, line in enumerate(lines[1:], start=1):
+            try:
+                ops.append(json.loads(line))
+            except json.JSONDecodeError:
+                if i == len(lines) - 1:
+                    break  # the last line was torn by a crash
+                raise
+        return header, ops
+
+    def _matches(self, header, ct_series_data):
+        # a checkpoint without an id has not been written by the viewer yet, the journal was started on top of it
+        return header.get("id") is not None and ct_series_data.get("journal_id") in (None, header["id"])
+
+    def replay(self, ct_series_data):
+        '''
+        Applies the operations missing in ct_series_data, returns their number
+        '''
+        if not os.path.exists(self.path):
+            return 0
+        header, ops = self._read()
+        if not self._matches(header, ct_series_data):
+            print(f"Journal {self.path} belongs to another checkpoint, it is not replayed")
+            return 0
+        saved_seq = ct_series_data.get("journal_seq", 0)
+        stashes = {}  # labels cleared during the replay
+        n = 0
+        for op in ops:
+            if op["seq"] <= saved_seq:
+                continue
+            if op["op"] == "clear":
+                stashes[op["stash"]] = ct_series_data["labels"]
+                ct_series_data["labels"] = {}
+            elif op["op"] == "restore":
+                # labels cleared before the checkpoint was saved are read from the stash written with it
+                stashed = stashes.pop(op["stash"], None)
+                ct_series_data["labels"] = stashed if stashed is not None else load_stash(self.checkpoint_path, op["stash"])
+            else:
+                apply_operation(ct_series_data["labels"], op)
+            self.replayed_series.add(op.get("series"))
+            n += 1
+        return n
+
+    def open(self, ct_series_data):
+        '''
+        Continues the journal of ct_series_data or starts a new one, a journal of another checkpoint is moved aside
+        '''
+        if os.path.exists(self.path):
+            header, ops = self._read()
+            if self._matches(header, ct_series_data):
+                self.id = header["id"]
+                self.saved_seq = ct_series_data.get("journal_seq", 0)
+                self.seq = max([self.saved_seq] + [op["seq"] for op in ops])
+                self.file = open(self.path, mode="a", encoding="UTF-8")
+                return
+            # its operations have not been replayed, so the journal is kept for manual recovery
+            aside_path = f"{self.path}.{header.get('id') or uuid.uuid4().hex}"
+            os.replace(self.path, aside_path)
+            print(f"Moved journal {self.path} of another checkpoint to {aside_path}")
+        self.id = ct_series_data.get("journal_id") or uuid.uuid4().hex
+        self.seq = self.saved_seq = ct_series_data.get("journal_seq", 0)
+        self._rewrite([])
+
+    def _rewrite(self, ops):
+        if self.file is not None:
+            self.file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, mode="w", encoding="UTF-8") as file:
+            file.write(json.dumps({"id": self.id}) + "\n")
+            for op in ops:
+                file.write(json.dumps(op, ensure_ascii=False) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, mode="a", encoding="UTF-8")
+
+    def append(self, op, **fields):
+        '''
+        Appends an operation (add, remove, set_series, clear, restore) and syncs it to disk
+        '''
+        if self.file is None:
+            return
+        with self.lock:
+            self.seq += 1
+            self.file.write(json.dumps({"seq": self.seq, "op": op, **fields}, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def mark(self, ct_series_data):
+        '''
+        Stores the journal position in ct_series_data before it is written to the checkpoint
+        '''
+        ct_series_data["journal_id"] = self.id
+        ct_series_data["journal_seq"] = self.seq
+        return self.seq
+
+    def needs_compaction(self):
+        return self.compact_every > 0 and self.seq - self.saved_seq >= self.compact_every
+
+    def truncate(self, saved_seq):
+        '''
+        Drops operations up to saved_seq once the checkpoint containing them is written
+        '''
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.flush()
+            _, ops = self._read()
+            self._rewrite([op for op in ops if op["seq"] > saved_seq])
+            self.saved_seq = saved_seq
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
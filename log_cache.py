@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class _LoGJob:
+    def __init__(self, key, n_slices):
+        self.key = key
+        self.volume = None  # allocated once the size of a filtered slice is known
+        self.done = np.zeros(n_slices, dtype=bool)
+        self.cancelled = False
+
+
+class LoGCache:
+    """
+    Whole-volume LoG responses computed on a background thread pool.
+
+    `request` starts filtering every slice of a volume under a key (sigma, windowing, ...),
+    `get` returns a filtered slice as soon as it is ready. Completed volumes are kept until
+    their total size exceeds max_size_gb, the least recently used ones are dropped first.
+    Only the latest request is computed, a new one cancels an unfinished job.
+    OpenCV filtering releases the GIL, so threads run in parallel.
+    """
+    def __init__(self, workers=4, max_size_gb=2.0, chunk_size=8):
+        self.executor = ThreadPoolExecutor(workers) if workers > 0 else None
+        self.max_size = int(max_size_gb * 1024**3)
+        self.chunk_size = chunk_size
+        self.volumes = OrderedDict()  # completed volumes by key
+        self.job = None
+        self.too_large = None  # key of the latest volume over max_size_gb, its slices are filtered one by one when displayed
+        self.lock = threading.Lock()
+
+    def request(self, key, n_slices, get_slice, filter_fn):
+        '''
+        Starts computing filter_fn(get_slice(i)) for every slice unless the volume of key is cached or being computed
+        '''
+        if self.executor is None:
+            return
+        with self.lock:
+            if key in self.volumes or (self.job is not None and self.job.key == key) or key == self.too_large:
+                return
+            if self.job is not None:
+                self.job.cancelled = True
+            self.job = _LoGJob(key, n_slices)
+        threading.Thread(target=self._run, args=(self.job, get_slice, filter_fn), daemon=True).start()
+
+    def _run(self, job, get_slice, filter_fn):
+        def filter_chunk(start):
+            for i in range(start, min(start + self.chunk_size, len(job.done))):
+                if job.cancelled:
+                    return
+                job.volume[i] = filter_fn(get_slice(i))
+                job.done[i] = True
+
+        try:
+            # the first slice is filtered here, not on the Tk thread, to learn the size of the volume
+            first = filter_fn(get_slice(0))
+            size = first.nbytes * len(job.done)
+            with self.lock:
+                if self.job is not job:
+                    return
+                if size > self.max_size:
+                    self.too_large = job.key
+                    self.job = None
+                    return
+                self._evict(self.max_size - size)
+                job.volume = np.empty((len(job.done), *first.shape), dtype=first.dtype)
+            job.volume[0] = first
+            job.done[0] = True
+            list(self.executor.map(filter_chunk, range(1, len(job.done), self.chunk_size)))
+        except Exception as e:
+            print(f"LoG precomputation failed: {e}")
+            job.cancelled = True
+
+        with self.lock:
+            if self.job is job:
+                self.job = None
+                if not job.cancelled:
+                    self.volumes[job.key] = job.volume
+
+    def get(self, key, idx):
+        '''
+        Returns the filtered slice idx of the volume of key or None if it is not computed yet
+        '''
+        with self.lock:
+            if key in self.volumes:
+                self.volumes.move_to_end(key)
+                return self.volumes[key][idx]
+            job = self.job
+        if job is not None and job.key == key and job.done[idx]:
+            return job.volume[idx]
+        return None
+
+    def clear(self):
+        with self.lock:
+            if self.job is not None:
+                self.job.cancelled = True
+                self.job = None
+            self.volumes.clear()
+            self.too_large = None
+
+    def _evict(self, limit):
+        total_size = sum(volume.nbytes for volume in self.volumes.values())
+        while self.volumes and total_size > limit:
+            _, volume = self.volumes.popitem(last=False)
+            total_size -= volume.nbytes
@@ -0,0 +1,69 @@
+import json
+import time
+from collections import deque
+from contextlib import nullcontext
+
+
+_DISABLED_STAGE = nullcontext()
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """
+    Timing of named stages of the render and loading paths.
+
+    `with profiler.stage(name):` measures a stage, when the profiler is disabled it returns
+    a shared no-op context. Keeps the latest and the average time of every stage, the frame rate,
+    and optionally appends every measurement as a JSON line to a trace file.
+    """
+    def __init__(self, enabled=False, trace_path=None, smoothing=0.1):
+        self.enabled = enabled or trace_path is not None
+        self.trace_file = open(trace_path, mode='a', encoding='UTF-8', buffering=1) if trace_path else None
+        self.smoothing = smoothing
+        self.last_ms = {}
+        self.avg_ms = {}
+        self.frame_times = deque(maxlen=30)
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _DISABLED_STAGE
+
+    def record(self, name, seconds, **info):
+        ms = seconds * 1000
+        self.last_ms[name] = ms
+        self.avg_ms[name] = ms if name not in self.avg_ms else self.avg_ms[name] + self.smoothing * (ms - self.avg_ms[name])
+        if self.trace_file is not None:
+            self.trace_file.write(json.dumps({"time": time.time(), "stage": name, "ms": round(ms, 3), **info}) + "\n")
+
+    def frame(self):
+        self.frame_times.append(time.perf_counter())
+
+    def fps(self):
+        if len(self.frame_times) < 2:
+            return 0.
+        return (len(self.frame_times) - 1) / max(self.frame_times[-1] - self.frame_times[0], 1e-9)
+
+    def summary(self):
+        '''
+        Returns HUD text: average ms of every stage and the frame rate
+        '''
+        lines = [f"{name:<16}{ms:7.2f} ms" for name, ms in self.avg_ms.items()]
+        lines.append(f"{'fps':<16}{self.fps():7.1f}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
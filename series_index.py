@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import argparse
+import threading
+
+import pydicom
+
+from series_loader import create_executor
+
+
+def read_index_entry(file_path):
+    '''
+    Reads (modality, SeriesInstanceUID, z position) from a DICOM header, missing values (or non-DICOM files) give None
+    '''
+    try:
+        dcm = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["Modality", "SeriesInstanceUID", "ImagePositionPatient"])
+    except Exception:
+        return None, None, None
+    position = dcm.get("ImagePositionPatient")
+    return dcm.get("Modality"), dcm.get("SeriesInstanceUID"), float(position[2]) if position is not None else None
+
+
+def _prefix_range(folder):
+    # every path under folder sorts between "folder/" and "folder0" ('0' is the character after the separator)
+    return folder + os.sep, folder + chr(ord(os.sep) + 1)
+
+
+def _matches_disk(folder, rows):
+    # the folder is listed (the same files as `update` indexes) and indexed files are stat'ed, which is much cheaper than parsing headers
+    on_disk = {os.path.join(root_dir, file) for root_dir, _, files in os.walk(folder) for file in files if file[0] != '.'}
+    if on_disk != {path for path, *_ in rows}:
+        return False
+    for path, size, mtime_ns, *_ in rows:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            return False
+    return True
+
+
+class SeriesIndex:
+    """
+    SQLite index of DICOM files under one or more parent folders.
+
+    For every file it stores size, mtime, modality, SeriesInstanceUID and z position, so folders
+    under an indexed parent can be resolved to ordered series file lists without parsing headers
+    (the folder is only listed to check the index is up to date). `update` only parses files which are new or changed.
+    """
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()  # the connection is shared with the prefetching thread
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY)")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, modality TEXT, series_uid TEXT, z REAL)""")
+
+    def update(self, parent, executor=None, batch_size=1000):
+        '''
+        Brings the index of parent up to date, returns the numbers of (re)parsed and removed files
+        '''
+        parent = os.path.realpath(parent)
+        with self.lock:
+            known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE path > ? AND path < ?", _prefix_range(parent))}
+
+        seen = set()
+        changed = []  # (path, size, mtime_ns)
+        for root_dir, _, files in os.walk(parent):
+            for file in files:
+                if file[0] == '.':
+                    continue
+                path = os.path.join(root_dir, file)
+                stat = os.stat(path)
+                seen.add(path)
+                if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((path, stat.st_size, stat.st_mtime_ns))
+        removed = [(path,) for path in known.keys() - seen]
+
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start + batch_size]
+            paths = [path for path, _, _ in batch]
+            entries = executor.map(read_index_entry, paths, chunksize=64) if executor is not None else map(read_index_entry, paths)
+            rows = [(path, size, mtime_ns, *entry) for (path, size, mtime_ns), entry in zip(batch, entries)]
+            with self.lock, self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+            print(f"Indexed {min(start + batch_size, len(changed))}/{len(changed)} new or changed files")
+
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO roots VALUES (?)", (parent,))
+        return len(changed), len(removed)
+
+    def lookup(self, folder):
+        '''
+        Returns ({series_uid: [file_path, ...]}, [(file_path, size, mtime_ns), ...]) for a folder under an indexed parent,
+        CT series files are in slice order and the second list has every indexed file of the folder.
+        Returns None if the folder is not indexed, holds .npy slices or has changed since the last `update`.
+        '''
+        folder = os.path.realpath(folder)
+        with self.lock:
+            roots = [root for root, in self.connection.execute("SELECT path FROM roots")]
+            if not any(folder == root or folder.startswith(root + os.sep) for root in roots):
+                return None
+            rows = self.connection.execute(
+                "SELECT path, size, mtime_ns, modality, series_uid, z FROM files WHERE path > ? AND path < ? ORDER BY series_uid, z, path",
+                _prefix_range(folder)).fetchall()
+
+        if any('npy' in os.path.dirname(path) for path, *_ in rows):
+            return None
+        if not rows or not _matches_disk(folder, rows):
+            print(f"Series index is out of date for {folder}, reading the folder")
+            return None
+
+        series = {}
+        for path, _, _, modality, series_uid, z in rows:
+            if modality == 'CT' and series_uid is not None and z is not None:
+                series.setdefault(series_uid, []).append(path)
+        return series, [(path, size, mtime_ns) for path, size, mtime_ns, *_ in rows]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Builds or updates the SQLite index of DICOM series used by cavai.py --index')
+    parser.add_argument(
+        'parents',
+        nargs='+',
+        help='parent folders to index')
+    parser.add_argument(
+        '--index',
+        required=True,
+        help='path to the SQLite index file (created if it does not exist)')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of parallel workers for header parsing')
+    parser.add_argument(
+        '--executor',
+        type=str,
+        choices=['process', 'thread'],
+        default='process',
+        help='kind of pool used with --workers')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    index = SeriesIndex(args.index)
+    executor = create_executor(args.workers, args.executor)
+    for parent in args.parents:
+        n_changed, n_removed = index.update(parent, executor)
+        print(f"{parent}: {n_changed} files (re)indexed, {n_removed} removed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+import os
+import queue
+import struct
+import threading
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pydicom
+
+
+SliceHeader = namedtuple("SliceHeader", ["file_path", "series_uid", "z"])
+
+# layout of uncompressed pixel data which can be read from the file as is (value_offset is the position of the pixel bytes)
+RawLayout = namedtuple("RawLayout", ["value_offset", "raw_dtype", "bits_stored", "shape", "slope", "intercept"])
+
+UNCOMPRESSED_SYNTAXES = (pydicom.uid.ImplicitVRLittleEndian, pydicom.uid.ExplicitVRLittleEndian)
+
+
+def create_executor(workers, kind="process"):
+    '''
+    Function returns a pool for parallel series loading (None means serial loading)
+    '''
+    if workers is None or workers <= 1:
+        return None
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    raise ValueError(f"unknown executor kind: {kind}")
+
+
+def _map(executor, fn, items):
+    if executor is None:
+        return map(fn, items)
+    return executor.map(fn, items, chunksize=16)
+
+
+def read_ct_header(file_path):
+    '''
+    Reads only the header of a DICOM file (no pixel data) and returns a SliceHeader for CT slices, None otherwise
+    '''
+    try:
+        dcm = pydicom.dcmread(file_path, stop_before_pixels=True)
+        if dcm[0x00080060].value != 'CT':  # checking modality
+            return None
+        if not hasattr(dcm, "ImagePositionPatient"):
+            return None
+        return SliceHeader(file_path, dcm.SeriesInstanceUID, float(dcm.ImagePositionPatient[2]))
+    except Exception as e:
+        print(f'Could not read file {os.path.basename(file_path)}, error:', e)
+        return None
+
+
+def to_volume_dtype(image, dtype):
+    '''
+    Converts HU values to the volume dtype, for integer dtypes (int16) values are rounded
+    '''
+    if np.dtype(dtype).kind == 'i' and image.dtype.kind == 'f':
+        info = np.iinfo(dtype)
+        image = np.clip(np.rint(image), info.min, info.max)
+    return image.astype(dtype, copy=False)
+
+
+def decode_ct_slice(file_path, dtype='float32'):
+    dcm = pydicom.dcmread(file_path)
+    pixels = dcm.pixel_array
+    bits_stored = dcm.get("BitsStored")
+    if dcm.get("PixelRepresentation") == 0 and bits_stored is not None and bits_stored < pixels.dtype.itemsize * 8:
+        pixels = pixels & ((1 << bits_stored) - 1)  # bits above BitsStored may hold overlays, the same as read_raw_dicom_series
+    image = to_volume_dtype(pydicom.pixel_data_handlers.apply_modality_lut(pixels, dcm), dtype)
+    # Making all paddings have the same value
+    image[image.astype(int) == -3024] = -2048.
+    return image
+
+
+def read_raw_layout(file_path):
+    '''
+    Returns RawLayout for uncompressed little endian 16 bit CT slices with a linear rescale, None for anything else
+    '''
+    with open(file_path, 'rb') as fp:
+        dcm = pydicom.dcmread(fp, stop_before_pixels=True)
+        element_offset = fp.tell()
+        element_header = fp.read(12)
+
+    transfer_syntax = dcm.file_meta.get("TransferSyntaxUID")
+    if transfer_syntax not in UNCOMPRESSED_SYNTAXES or len(element_header) < 12:
+        return None
+    if dcm.get("BitsAllocated") != 16 or dcm.get("SamplesPerPixel", 1) != 1 or int(dcm.get("NumberOfFrames") or 1) != 1:
+        return None
+    if "ModalityLUTSequence" in dcm:
+        return None
+    pixel_representation, bits_stored, rows, columns = (dcm.get(keyword) for keyword in ("PixelRepresentation", "BitsStored", "Rows", "Columns"))
+    if None in (pixel_representation, bits_stored, rows, columns) or not 0 < bits_stored <= 16:
+        return None  # left to pydicom, which reports broken headers
+    if pixel_representation == 1 and bits_stored != 16:
+        return None  # would need sign extension
+    if struct.unpack('<HH', element_header[:4]) != (0x7FE0, 0x0010):
+        return None
+
+    if transfer_syntax == pydicom.uid.ExplicitVRLittleEndian:
+        length, = struct.unpack('<I', element_header[8:12])
+        value_offset = element_offset + 12
+    else:
+        length, = struct.unpack('<I', element_header[4:8])
+        value_offset = element_offset + 8
+    shape = (int(rows), int(columns))
+    if length != shape[0] * shape[1] * 2:
+        return None
+
+    # the same rescale as pydicom's apply_modality_lut
+    if 'RescaleSlope' in dcm and 'RescaleIntercept' in dcm:
+        slope, intercept = float(dcm.RescaleSlope), float(dcm.RescaleIntercept)
+    else:
+        slope, intercept = 1., 0.
+    raw_dtype = '<i2' if pixel_representation == 1 else '<u2'
+    return RawLayout(value_offset, raw_dtype, int(bits_stored), shape, slope, intercept)
+
+
+def _read_into(file_path, offset, out):
+    with open(file_path, 'rb') as fp:
+        fp.seek(offset)
+        if fp.readinto(memoryview(out).cast('B')) != out.nbytes:
+            raise ValueError(f"truncated pixel data in {file_path}")
+
+
+def read_raw_dicom_series(file_paths, executor=None, dtype='float32', chunk_size=16):
+    '''
+    Fast path of phase two for uncompressed series: pixel bytes are read straight into preallocated memory
+    and the rescale and padding replacement are applied to many slices at once.
+    Returns None if any slice is compressed or has an unusual pixel format.
+    '''
+    if not file_paths:
+        return None
+    first = read_raw_layout(file_paths[0])
+    if first is None:
+        return None  # compressed series are detected from one header instead of a pass over all of them
+    layouts = [first] + list(_map(executor, read_raw_layout, file_paths[1:]))
+    if any(layout is None for layout in layouts) or len({(layout.shape, layout.raw_dtype) for layout in layouts}) != 1:
+        return None
+
+    shape, raw_dtype = layouts[0].shape, layouts[0].raw_dtype
+    slopes = np.array([layout.slope for layout in layouts])[:, np.newaxis, np.newaxis]
+    intercepts = np.array([layout.intercept for layout in layouts])[:, np.newaxis, np.newaxis]
+    volume = np.empty((len(file_paths),) + shape, dtype=dtype)
+
+    if volume.dtype == np.int16 and raw_dtype == '<u2' and all(layout.bits_stored <= 15 for layout in layouts) and \
+       np.all(slopes == 1) and np.all(intercepts == np.round(intercepts)) and np.all((-32768 <= intercepts) & (intercepts <= 0)):
+        # stored values are below 2**15, so they are read into the int16 volume as is and cannot overflow after the rescale
+        for i, (file_path, layout) in enumerate(zip(file_paths, layouts)):
+            _read_into(file_path, layout.value_offset, volume[i])
+            volume[i] &= np.int16((1 << layout.bits_stored) - 1)  # bits above BitsStored may hold overlays, the same as decode_ct_slice
+        volume += intercepts.astype(np.int16)
+        volume[volume == -3024] = -2048
+        return volume
+
+    raw = np.empty((chunk_size,) + shape, dtype=raw_dtype)
+    hu = np.empty((chunk_size,) + shape, dtype=np.float64)
+    is_int = volume.dtype.kind == 'i'
+    for start in range(0, len(file_paths), chunk_size):
+        stop = min(start + chunk_size, len(file_paths))
+        n = stop - start
+        for j in range(n):
+            layout = layouts[start + j]
+            _read_into(file_paths[start + j], layout.value_offset, raw[j])
+            if raw_dtype == '<u2' and layout.bits_stored < 16:
+                raw[j] &= np.uint16((1 << layout.bits_stored) - 1)
+        np.multiply(raw[:n], slopes[start:stop], out=hu[:n])
+        hu[:n] += intercepts[start:stop]
+        if is_int:
+            info = np.iinfo(volume.dtype)
+            np.clip(np.rint(hu[:n], out=hu[:n]), info.min, info.max, out=hu[:n])
+        chunk = volume[start:stop]
+        chunk[...] = hu[:n]
+        # Making all paddings have the same value (the same truncation as image.astype(int) == -3024)
+        chunk[(chunk <= -3024) & (chunk > -3025)] = -2048
+    return volume
+
+
+def scan_dicom_series(file_paths, executor=None):
+    '''
+    Phase one of loading: groups CT slices by SeriesInstanceUID reading headers only,
+    every series is a list of SliceHeader in the order of file_paths
+    '''
+    series = {}
+    for header in _map(executor, read_ct_header, file_paths):
+        if header is None:
+            continue
+        series.setdefault(header.series_uid, []).append(header)
+    return series
+
+
+def decode_dicom_series(file_paths, executor=None, dtype='float32'):
+    '''
+    Phase two of loading: decodes slices of a single series into a preallocated volume [slices, height, width] keeping the order of file_paths
+    '''
+    volume = read_raw_dicom_series(file_paths, executor, dtype)
+    if volume is not None:
+        return volume
+
+    decode = partial(decode_ct_slice, dtype=dtype)
+    first = decode(file_paths[0])
+    volume = np.empty((len(file_paths),) + first.shape, dtype=first.dtype)
+    volume[0] = first
+    for i, image in enumerate(_map(executor, decode, file_paths[1:]), start=1):
+        volume[i] = image
+    return volume
+
+
+def stack_npy_slices(file_paths, dtype=None):
+    '''
+    Reads .npy slices into a preallocated volume (optionally converting them to dtype)
+    '''
+    first = np.load(file_paths[0])
+    volume = np.empty((len(file_paths),) + first.shape, dtype=dtype or first.dtype)
+    volume[0] = to_volume_dtype(first, volume.dtype)
+    for i, file_path in enumerate(file_paths[1:], start=1):
+        volume[i] = to_volume_dtype(np.load(file_path), volume.dtype)
+    return volume
+
+
+
+class ProgressiveLoader:
+    """
+    Decodes a series into a preallocated volume on a background thread.
+
+    Slices closest to `focus` (the slice under the slider) are decoded first and `loaded` marks
+    slices which are already in the volume, so the viewer can show them while the rest is decoding.
+    """
+    def __init__(self, file_paths, executor=None, focus=0, max_pending=16, dtype='float32'):
+        self.file_paths = file_paths
+        self.executor = executor
+        self.decode = partial(decode_ct_slice, dtype=dtype)
+        self.max_pending = max_pending
+        self.focus = min(max(focus, 0), len(file_paths) - 1)
+
+        first = self.decode(file_paths[self.focus])
+        self.volume = np.empty((len(file_paths),) + first.shape, dtype=first.dtype)
+        self.volume[self.focus] = first
+        self.loaded = np.zeros(len(file_paths), dtype=bool)
+        self.loaded[self.focus] = True
+
+        self.done = False
+        self.cancelled = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _next_indices(self, n, pending):
+        waiting = ~self.loaded
+        waiting[list(pending)] = False
+        candidates = np.flatnonzero(waiting)
+        order = np.argsort(np.abs(candidates - self.focus), kind='stable')
+        return candidates[order[:n]]
+
+    def _store(self, idx, decode):
+        try:
+            self.volume[idx] = decode()
+        except Exception as e:
+            print(f'Could not decode file {os.path.basename(self.file_paths[idx])}, error:', e)
+            self.volume[idx] = -2048.
+        self.loaded[idx] = True
+
+    def _run(self):
+        if self.executor is None:
+            while not self.cancelled:
+                indices = self._next_indices(1, ())
+                if not len(indices):
+                    break
+                idx = indices[0]
+                self._store(idx, lambda: self.decode(self.file_paths[idx]))
+        else:
+            pending = {}  # future -> slice index
+            while not self.cancelled:
+                for idx in self._next_indices(self.max_pending - len(pending), pending.values()):
+                    pending[self.executor.submit(self.decode, self.file_paths[idx])] = idx
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self._store(pending.pop(future), future.result)
+            for future in pending:
+                future.cancel()
+        self.done = True
+
+
+class SliceStack:
+    """
+    A volume of .npy slices, every slice is memory-mapped on first access.
+
+    Supports len(), iteration and integer indexing, so it can be used in place of a 3d numpy array
+    wherever the volume is processed slice by slice.
+    """
+    def __init__(self, file_paths):
+        self.file_paths = file_paths
+        self.slices = [None] * len(file_paths)
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __getitem__(self, idx):
+        idx = range(len(self.file_paths))[idx]
+        if self.slices[idx] is None:
+            self.slices[idx] = np.load(self.file_paths[idx], mmap_mode='r')
+        return self.slices[idx]
+
+    def __iter__(self):
+        for idx in range(len(self.file_paths)):
+            yield self[idx]
+
+
+class SeriesPrefetcher:
+    """
+    Iterates over (path, load_fn(path)) reading the next series on a background thread.
+
+    At most `depth` read series wait in the queue, so besides the series being processed
+    by the consumer no more than depth + 1 series are held in memory.
+    """
+    def __init__(self, paths, load_fn, depth=1):
+        self.paths = paths
+        self.load_fn = load_fn
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for path in self.paths:
+            try:
+                self.queue.put((path, self.load_fn(path), None))
+            except Exception as e:
+                self.queue.put((path, None, e))
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, result, error = item
+            if error is not None:
+                raise error
+            yield path, result
@@ -1,5 +1,7 @@
 import os
 import glob
+from functools import lru_cache
+from collections import OrderedDict
 
 import cv2
 import numpy as np
@@ -7,24 +9,152 @@ import numpy as np
 from constants import IMAGE_SIZE
 
 
-def LoG_filter(image, sigma, size=None):
-    # Generate LoG kernel
+def LoG_kernel_size(sigma, size=None):
     if size is None:
         size = int(6 * sigma + 1) if sigma >= 1 else 7
 
     if size % 2 == 0:
         size += 1
+    return size
 
+
+@lru_cache(maxsize=16)
+def LoG_kernel(sigma, size):
+    '''
+    Returns the dense size x size LoG kernel normalised by the sum of its absolute values (cached, read-only)
+    '''
     x, y = np.meshgrid(np.arange(-size//2+1, size//2+1), np.arange(-size//2+1, size//2+1))
     kernel = -(1/(np.pi * sigma**4)) * (1 - ((x**2 + y**2) / (2 * sigma**2))) * np.exp(-(x**2 + y**2) / (2 * sigma**2))
     kernel = kernel / np.sum(np.abs(kernel))
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=16)
+def LoG_separable_kernels(sigma, size):
+    '''
+    Returns 1d kernels (a, b) with LoG_kernel(sigma, size) == outer(b, a) + outer(a, b):
+    the LoG is a sum of two Gaussian second derivative terms, each separable into a 1d second derivative
+    along one axis and a 1d Gaussian along the other (cached, read-only)
+    '''
+    x = np.arange(-size//2+1, size//2+1, dtype=np.float64)
+    gaussian = np.exp(-x**2 / (2 * sigma**2))
+    second_derivative = -(1/(np.pi * sigma**4)) * (0.5 - x**2 / (2 * sigma**2)) * gaussian
+
+    # same normalisation as the dense kernel
+    norm = np.sum(np.abs(np.outer(gaussian, second_derivative) + np.outer(second_derivative, gaussian)))
+    a, b = second_derivative / norm, gaussian
+    a.flags.writeable = False
+    b.flags.writeable = False
+    return a, b
 
-    # Perform convolution using OpenCV filter2D
-    result = cv2.filter2D(image, -1, kernel)
 
+def LoG_filter(image, sigma, size=None, separable=True):
+    '''
+    Filters image with the LoG kernel of sigma (kernels are cached per (sigma, size)).
+    The separable form runs two pairs of 1d convolutions instead of a dense 2d one, it matches the dense
+    filter2D result up to float32 rounding: within 1e-5 of the response range for float images,
+    and within 1 (a rounding step) for uint8 images, which are filtered in float32 and saturated back to uint8
+    '''
+    size = LoG_kernel_size(sigma, size)
+
+    if not separable:
+        # Perform convolution using OpenCV filter2D
+        return cv2.filter2D(image, -1, LoG_kernel(sigma, size))
+
+    a, b = LoG_separable_kernels(sigma, size)
+    ddepth = cv2.CV_32F if image.dtype == np.uint8 else -1
+    result = cv2.sepFilter2D(image, ddepth, a, b)
+    result += cv2.sepFilter2D(image, ddepth, b, a)
+    if image.dtype == np.uint8:
+        result = np.rint(result).clip(0, 255).astype(np.uint8)
     return result
 
 
+def LoG_response(ct_slice, sigma, replace_bg=False):
+    '''
+    LoG of a windowed (uint8) or HU slice, HU are filtered as float32 with the -2048 background optionally set to -1000
+    (there is no background value to replace in windowed slices)
+    '''
+    if ct_slice.dtype != np.uint8:
+        ct_slice = np.array(ct_slice, dtype=np.float32)
+        if replace_bg:
+            ct_slice[ct_slice == -2048.0] = -1000.
+    return LoG_filter(ct_slice, sigma)
+
+
+@lru_cache(maxsize=32)
+def window_lut(minval, maxval, dtype='int16'):
+    '''
+    Returns a 64K-entry uint8 lookup table of the window for 16-bit integer images,
+    the table is indexed by the raw (uint16) bits of a pixel
+    '''
+    values = np.arange(2**16, dtype=np.uint16).view(dtype).astype(np.float32)
+    return ((values - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+
+
+def apply_window(img, minval, maxval):
+    img = np.asarray(img)
+    if img.dtype in (np.int16, np.uint16):
+        # integer HU are windowed with a single gather from the lookup table
+        return window_lut(minval, maxval, img.dtype.name).take(img.view(np.uint16))
+    img = img.astype(np.float32, copy=False)
+    return ((img - minval) / (maxval - minval) * 255).clip(0, 255).astype('uint8')
+
+
+class LRUCache:
+    '''
+    Bounded mapping which drops the least recently used entries once it holds more than maxsize of them
+    '''
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize > 0:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class WindowedSlices:
+    '''
+    Windowed view of a volume, a slice is windowed only when it is accessed.
+    Windowed slices are kept in cache under (slice, level, width, view)
+    '''
+    def __init__(self, volume, level, width, view, cache=None):
+        self.volume = volume
+        self.level = level
+        self.width = width
+        self.view = view
+        self.cache = cache if cache is not None else LRUCache(0)
+        self.minval = level - (width / 2)
+        self.maxval = level + (width / 2)
+
+    def __len__(self):
+        return len(self.volume)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        return self.cache.get((idx, self.level, self.width, self.view),
+                              lambda: apply_window(self.volume[idx], self.minval, self.maxval))
+
+
 def to_interval(value, start=0, end=IMAGE_SIZE-1):
     if value < start:
         return start
@@ -79,5 +209,108 @@ def parse_detected_bboxes(path, img_size):
     return dct
 
 
+def _slab_block(volume, start, stop, fill, first):
+    # slices start..stop-1 of the volume, positions outside of it are filled with the identity of the reduction
+    block = np.full((stop - start, *first.shape), fill, dtype=first.dtype)
+    lo, hi = max(start, 0), min(stop, len(volume))
+    if lo < hi:
+        block[lo-start:hi-start] = volume[lo:hi] if isinstance(volume, np.ndarray) else np.stack([volume[i] for i in range(lo, hi)])
+    return block
+
+
+def slab_reduce(volume, thickness, ufunc=np.maximum):
+    '''
+    Reduces the slab of `thickness` slices centred on every slice with ufunc (np.maximum for MIP),
+    returns a volume with as many slices as the input.
+    Uses the van Herk/Gil-Werman sliding window: the volume is split into blocks of `thickness` slices,
+    every slab is the union of a suffix of one block and a prefix of the next one,
+    so each output slice costs 3 ufunc calls whatever the thickness
+    '''
+    n = len(volume)
+    first = np.asarray(volume[0])
+    dtype = first.dtype
+    limits = np.finfo(dtype) if dtype.kind == 'f' else np.iinfo(dtype)
+    fill = (-np.inf if dtype.kind == 'f' else limits.min) if ufunc is np.maximum else (np.inf if dtype.kind == 'f' else limits.max)
+
+    offset = (thickness - 1) // 2  # slab of slice i is [i - offset, i - offset + thickness)
+    result = np.empty((n, *first.shape), dtype=dtype)
+    block = _slab_block(volume, -offset, thickness - offset, fill, first)
+    for start in range(0, n, thickness):
+        count = min(thickness, n - start)
+        suffix = block  # ufunc.accumulate along axis 0 is much slower than slice by slice calls
+        for i in range(thickness - 2, -1, -1):
+            ufunc(suffix[i], suffix[i+1], out=suffix[i])
+        block = _slab_block(volume, start + thickness - offset, start + 2*thickness - offset, fill, first)
+        prefix = block[:count-1].copy()
+        for i in range(1, count - 1):
+            ufunc(prefix[i], prefix[i-1], out=prefix[i])
+        result[start] = suffix[0]
+        ufunc(suffix[1:count], prefix, out=result[start+1:start+count])
+    return result
+
+
+def slab_mean(volume, thickness):
+    '''
+    Averages the slab of `thickness` slices centred on every slice (slabs are cut at the series ends),
+    returns a float32 volume with as many slices as the input.
+    Slab sums are kept as a difference of running cumulative sums (slices are added at the front
+    and subtracted at the back of the slab), so each output slice costs O(1) whatever the thickness
+    '''
+    n = len(volume)
+    first = np.asarray(volume[0])
+    offset = (thickness - 1) // 2
+    result = np.empty((n, *first.shape), dtype=np.float32)
+    total = np.zeros(first.shape, dtype=np.float64)  # sum of slices lo..hi-1
+    lo = hi = 0
+    for i in range(n):
+        new_lo, new_hi = max(i - offset, 0), min(i - offset + thickness, n)
+        for j in range(hi, new_hi):
+            total += volume[j]
+        for j in range(lo, new_lo):
+            total -= volume[j]
+        lo, hi = new_lo, new_hi
+        np.divide(total, hi - lo, out=result[i], casting='unsafe')
+    return result
+
+
+def _reduce_series(np_img, ufunc, dtype=None):
+    # single image of the whole series, lazily loaded volumes are reduced slice by slice
+    if isinstance(np_img, np.ndarray):
+        return ufunc.reduce(np_img, axis=0, dtype=dtype)[np.newaxis]
+    image = np.array(np_img[0], dtype=dtype)
+    for i in range(1, len(np_img)):
+        ufunc(image, np_img[i], out=image, casting='unsafe')
+    return image[np.newaxis]
+
+
 def createMIP(np_img, slices_num=15):
-    return np.max(np_img, axis=0)
+    '''
+    Function returns slab MIP volume (MIP of slices_num slices around every slice),
+    slices_num=0 gives a single MIP image of the whole series
+    '''
+    if slices_num > 0:
+        return slab_reduce(np_img, slices_num, np.maximum)
+    return _reduce_series(np_img, np.maximum)
+
+
+def createMinIP(np_img, slices_num=15):
+    '''
+    Function returns slab MinIP volume, slices_num=0 gives a single MinIP image of the whole series
+    '''
+    if slices_num > 0:
+        return slab_reduce(np_img, slices_num, np.minimum)
+    return _reduce_series(np_img, np.minimum)
+
+
+def createAvgIP(np_img, slices_num=15):
+    '''
+    Function returns slab average intensity projection volume (float32),
+    slices_num=0 gives a single AvgIP image of the whole series
+    '''
+    if slices_num > 0:
+        return slab_mean(np_img, slices_num)
+    return (_reduce_series(np_img, np.add, np.float64) / len(np_img)).astype(np.float32)
+
+
+# slab projection views of CTViewer
+PROJECTIONS = {"mip": createMIP, "minip": createMinIP, "avgip": createAvgIP}
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+import numpy as np
+
+
+def stats_signature(root, entries):
+    '''
+    Function returns a hash of (file_path, size, mtime_ns) entries with paths taken relative to root
+    '''
+    sha = hashlib.sha1()
+    for file_path, size, mtime_ns in sorted((os.path.relpath(file_path, root), size, mtime_ns) for file_path, size, mtime_ns in entries):
+        sha.update(f"{file_path}\0{size}\0{mtime_ns}\n".encode("UTF-8"))
+    return sha.hexdigest()
+
+
+def files_signature(root, file_paths):
+    '''
+    Function returns a hash of file names, sizes and modification times (changes whenever the folder content changes)
+    '''
+    return stats_signature(root, ((file_path, stat.st_size, stat.st_mtime_ns) for file_path in file_paths for stat in [os.stat(file_path)]))
+
+
+class VolumeCache:
+    """
+    On-disk cache of decoded series.
+
+    Every opened folder gets an entry directory with meta.json (folder signature and the ordered
+    file list of every series found in the folder) and one .npy volume per decoded series and dtype.
+    Volumes are read back memory-mapped; the least recently used ones are evicted
+    once the cache grows over max_size_gb. Access is serialized by a lock, the series prefetching
+    thread uses the cache together with the Tk thread.
+    """
+    def __init__(self, cache_dir, max_size_gb=20.0):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024**3)
+        self.lock = threading.RLock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, path):
+        return os.path.join(self.cache_dir, hashlib.sha1(os.path.realpath(path).encode("UTF-8")).hexdigest())
+
+    def _volume_path(self, path, series_uid, dtype):
+        volume_key = f"{series_uid}:{np.dtype(dtype).name}"
+        return os.path.join(self._entry_dir(path), hashlib.sha1(volume_key.encode("UTF-8")).hexdigest() + ".npy")
+
+    def lookup(self, path, signature):
+        '''
+        Returns {series_uid: [file_path, ...]} (files in slice order) for a cached folder or None
+        '''
+        meta_path = os.path.join(self._entry_dir(path), "meta.json")
+        with self.lock:
+            try:
+                with open(meta_path, mode='r', encoding='UTF-8') as file:
+                    meta = json.load(file)
+            except (OSError, ValueError):
+                return None
+            if meta["signature"] != signature:
+                # folder content changed, cached volumes are stale
+                shutil.rmtree(self._entry_dir(path), ignore_errors=True)
+                return None
+            return meta["series"]
+
+    def load_volume(self, path, series_uid, dtype='float32'):
+        volume_path = self._volume_path(path, series_uid, dtype)
+        with self.lock:
+            try:
+                os.utime(volume_path)  # marking as recently used
+                return np.load(volume_path, mmap_mode='r')
+            except FileNotFoundError:
+                return None
+
+    def store(self, path, signature, series, series_uid, volume):
+        '''
+        Saves the series file lists of a folder and the decoded volume of series_uid
+        '''
+        entry_dir = self._entry_dir(path)
+        with self.lock:
+            os.makedirs(entry_dir, exist_ok=True)
+
+            meta_path = os.path.join(entry_dir, "meta.json")
+            with open(meta_path + ".tmp", mode='w', encoding='UTF-8') as file:
+                json.dump({"path": os.path.realpath(path), "signature": signature, "series": series}, file, ensure_ascii=False)
+            os.replace(meta_path + ".tmp", meta_path)
+
+            volume_path = self._volume_path(path, series_uid, volume.dtype)
+            with open(volume_path + ".tmp", mode='wb') as file:
+                np.save(file, volume)
+            os.replace(volume_path + ".tmp", volume_path)
+
+            self.evict(keep=volume_path)
+
+    def evict(self, keep=None):
+        # entries can also be removed by another viewer sharing the cache directory
+        with self.lock:
+            volumes = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_dir():
+                    continue
+                try:
+                    for file in os.scandir(entry.path):
+                        if file.name.endswith(".npy"):
+                            stat = file.stat()
+                            volumes.append((stat.st_mtime, stat.st_size, file.path))
+                except FileNotFoundError:
+                    continue
+
+            total_size = sum(size for _, size, _ in volumes)
+            for _, size, volume_path in sorted(volumes):
+                if total_size <= self.max_size:
+                    break
+                if volume_path == keep:
+                    continue
+                try:
+                    os.remove(volume_path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size